@@ -0,0 +1,145 @@
+# 生成流程基准测试：运行时合成三张模板 (合并区域布局仿照真实表单)，无界面驱动生成引擎，
+# 统计耗时、内存峰值、每条行程成本，并与保存的基线比较。
+#   python bench_travel_tool.py                    跑一遍并与 bench_baseline.json 比较
+#   python bench_travel_tool.py --save-baseline    把本次结果存为基线
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import openpyxl
+from openpyxl.styles import Border, Side
+
+import travel_tool as tt
+
+TRIP_COUNTS = (1, 6, 60, 600)
+NOCAR_COUNT = 50
+BASELINE_FILE = "bench_baseline.json"
+
+def build_templates(folder):
+    thin = Side(style='thin')
+    border = Border(left=thin, right=thin, top=thin, bottom=thin)
+    def grid(ws, rows, cols=15):
+        for r in rows:
+            for c in range(1, cols + 1): ws.cell(r, c).border = border
+    paths = {k: os.path.join(folder, f"{k}.xlsx") for k in ("expense", "audit", "no_car")}
+
+    # 报销单：表头、6 行明细 (每行 3 个合并区域)、合计行、收款人行
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws['A1'] = '差旅费报销单'
+    for rng in ('A1:O1', 'B3:E3', 'G3:O3', 'B4:C4', 'E4:F4', 'G4:I4', 'J4:O4', 'A5:C5', 'A6:C6',
+                'A14:F14', 'G14:O14', 'C15:E15', 'F15:J15', 'K15:M15', 'N15:O15', 'A16:O16'):
+        ws.merge_cells(rng)
+    grid(ws, range(3, 16))
+    for r in range(8, 14):
+        for rng in (f'F{r}:G{r}', f'J{r}:L{r}', f'N{r}:O{r}'): ws.merge_cells(rng)
+        ws.row_dimensions[r].height = 18
+    wb.save(paths['expense'])
+
+    # 审核单
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws['A1'] = '报销审核单'
+    for rng in ('A1:O2', 'E6:O6', 'J10:O10', 'C11:O11', 'C12:E12', 'F12:J12', 'K12:M12', 'N12:O12'):
+        ws.merge_cells(rng)
+    grid(ws, range(4, 14))
+    wb.save(paths['audit'])
+
+    # 未派车证明
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws['A1'] = '未派车证明'
+    for rng in ('A1:K1', 'B5:D5', 'E5:G5', 'H5:K5', 'B7:K7'): ws.merge_cells(rng)
+    grid(ws, range(3, 10), 11)
+    wb.save(paths['no_car'])
+    return paths
+
+def make_trips(n, nocar_every=0):
+    start = datetime(2024, 1, 1)
+    trips = []
+    for i in range(n):
+        d = (start + timedelta(days=i % 365)).toordinal()
+        trips.append(tt.Trip(d, "龙潭", "辖区" if i % 3 else "桃源县", 40 if i % 3 else 0, 0 if i % 3 else 30,
+                             bool(nocar_every) and i % nocar_every == 0, "线路巡视", d, d))
+    return trips
+
+def measure(fn, repeat):
+    # 先热身一次 (模板进缓存)，再取多次运行的中位数；内存峰值单独跑一次 tracemalloc
+    fn()
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return sorted(times)[len(times) // 2], peak
+
+def run(repeat):
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        config = dict(tt.DEFAULT_CONFIG, template_paths=build_templates(folder))
+        user = {"name": "测试", "phone": "13800000000", "bank": "中国农业银行", "card": "6228480000000000000"}
+        fill_date = datetime(2024, 12, 31)
+        cases = [(f"generate_{n}_trips", make_trips(n)) for n in TRIP_COUNTS]
+        cases.append((f"generate_{NOCAR_COUNT}_nocar", make_trips(NOCAR_COUNT, nocar_every=1)))
+        for backend in ("openpyxl", "xml"):
+            cfg = dict(config, render_backend=backend)
+            for name, trips in cases:
+                wall, peak = measure(lambda: tt.generate_documents(cfg, user, trips, fill_date, folder, workers=1, cache=False), repeat)
+                results[f"{name}[{backend}]"] = {"seconds": wall, "peak_bytes": peak, "per_trip_ms": wall / len(trips) * 1000}
+
+        ws = openpyxl.load_workbook(config['template_paths']['expense']).active
+        writer = tt.SheetWriter(ws)
+        coords = [f"{c}{r}" for r in range(3, 16) for c in "ABCDEFGHIJKLMNO"]
+        wall, peak = measure(lambda: [writer.write(c, 1) for c in coords], repeat)
+        results["sheet_write_x195"] = {"seconds": wall, "peak_bytes": peak}
+        amounts = [i * 7.35 for i in range(1000)]
+        wall, peak = measure(lambda: [tt.num_to_cn_amount(a) for a in amounts], repeat)
+        results["num_to_cn_amount_x1000"] = {"seconds": wall, "peak_bytes": peak}
+    return results
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    print(f"{'case':36} {'ms':>10} {'base ms':>10} {'change':>8} {'peak KiB':>10} {'ms/trip':>8}")
+    for name, r in results.items():
+        base = baseline.get(name)
+        change = (r['seconds'] / base['seconds'] - 1) if base and base['seconds'] else None
+        per_trip = f"{r['per_trip_ms']:8.2f}" if 'per_trip_ms' in r else ""
+        print(f"{name:36} {r['seconds'] * 1000:10.2f} {base['seconds'] * 1000 if base else float('nan'):10.2f} "
+              f"{change * 100 if change is not None else float('nan'):7.1f}% {r['peak_bytes'] / 1024:10.0f} {per_trip}")
+        if change is not None and change > tolerance: regressions.append(name)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="差旅费工具生成流程基准测试")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="基线文件")
+    parser.add_argument("--save-baseline", action="store_true", help="把本次结果存为基线")
+    parser.add_argument("--repeat", type=int, default=5, help="每个用例重复次数 (取中位数)")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="比基线慢多少算回退 (默认 20%%)")
+    args = parser.parse_args(argv)
+
+    results = run(args.repeat)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f: baseline = json.load(f)['results']
+    regressions = compare(results, baseline, args.tolerance)
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({"saved_at": datetime.now().isoformat(timespec='seconds'), "python": sys.version.split()[0],
+                       "openpyxl": openpyxl.__version__, "results": results}, f, indent=2)
+        print(f"基线已保存到 {args.baseline}")
+    if regressions:
+        print(f"性能回退 (超过 {args.tolerance:.0%}): {', '.join(regressions)}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,38 @@
+from datetime import datetime
+
+import pytest
+
+import travel_tool as tt
+
+@pytest.mark.parametrize("num, text", [
+    (0, "零元整"),
+    (0.0, "零元整"),
+    (70, "柒拾元整"),
+    (70.0, "柒拾元整"), # 规则读进来是 float，整数元同样要带“整”
+    (30.0, "叁拾元整"),
+    (1500, "壹仟伍佰元整"),
+    (12.5, "壹拾贰元伍角"),
+    (12.05, "壹拾贰元伍分"),
+    (12.35, "壹拾贰元叁角伍分"),
+    (0.1 + 0.2, "元叁角"),
+])
+def test_num_to_cn_amount(num, text):
+    assert tt.num_to_cn_amount(num) == text
+
+def test_priced_total_is_whole():
+    table = tt.PricingTable.from_config(tt.DEFAULT_CONFIG).table
+    total = sum(table[("local", "same_day")]) + sum(table[("county", "same_day")]) # 40.0 + 30.0
+    assert tt.num_to_cn_amount(total) == "柒拾元整"
+
+@pytest.mark.parametrize("num, text", [(30.0, "30"), (100, "100"), (12.50, "12.5"), (0.1 + 0.2, "0.3")])
+def test_fmt_amount(num, text):
+    assert tt.fmt_amount(num) == text
+
+def test_manifest_trip_amounts_total_is_whole():
+    # 清单/服务请求里的金额经 Trip.from_dict 变成 float，审核单大写合计仍要带“整”
+    user = {"name": "张三", "phone": "13800000000", "bank": "中国农业银行", "card": "6228480000000000000"}
+    trips = [tt.Trip.from_dict({"date": "2024-05-06", "start": "本所", "end": "桃源县", "food": "40", "misc": 0}),
+             tt.Trip.from_dict({"date": "2024-05-07", "start": "本所", "end": "桃源县", "food": 0, "misc": "30"})]
+    cells = dict(tt.audit_cells(tt.DEFAULT_CONFIG, user, trips, datetime(2024, 5, 31)))
+    assert cells['J10'] == 70
+    assert cells['C11'] == "柒拾元整"
@@ -0,0 +1,37 @@
+from datetime import datetime
+
+import pytest
+
+import travel_tool as tt
+
+USERS = [{"name": "张三", "phone": "13800000000", "bank": "中国农业银行", "card": "6228480000000000000"}]
+
+@pytest.fixture
+def store(tmp_path):
+    s = tt.TripStore(str(tmp_path / "trips.db"))
+    yield s
+    s.close()
+
+def write_csv(tmp_path, lines):
+    path = tmp_path / "trips.csv"
+    path.write_text("\n".join(["姓名,出发日期,返回日期,终点,事由"] + lines) + "\n", encoding="utf-8")
+    return str(path)
+
+@pytest.mark.parametrize("value", ["", " ", "\t"])
+def test_parse_import_date_blank_is_value_error(value):
+    with pytest.raises(ValueError):
+        tt.parse_import_date(value)
+
+def test_blank_date_row_is_reported_and_rest_imported(store, tmp_path):
+    config = dict(tt.DEFAULT_CONFIG, users=USERS)
+    path = write_csv(tmp_path, [
+        "张三,2024-05-06,,桃源县,巡线",
+        "张三, ,,桃源县,巡线",
+        "张三,2024-05-08, ,桃源县,巡线", # 返回日期只有空格：按当天往返处理
+    ])
+    rows, added, errors = tt.import_trips(store, config, path)
+    assert rows == 3
+    assert errors == [(3, "日期无效")]
+    days = sorted(t.date for t in store.query(user="张三"))
+    assert days == [datetime(2024, 5, 6), datetime(2024, 5, 8)]
+    assert added == 2
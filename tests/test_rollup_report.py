@@ -0,0 +1,33 @@
+from datetime import datetime
+
+import openpyxl
+import pytest
+
+import travel_tool as tt
+
+@pytest.fixture
+def store(tmp_path):
+    s = tt.TripStore(str(tmp_path / "trips.db"))
+    yield s
+    s.close()
+
+def trip(day, end, food, misc):
+    return tt.Trip(datetime(2024, 5, day).toordinal(), "本所", end, food, misc)
+
+def test_report_uppercase_totals(store, tmp_path):
+    # 台账里的金额是 float，整数元的合计大写也要带“整”
+    store.add("张三", [trip(6, "桃源县", 40.0, 0.0), trip(7, "桃源县", 0.0, 30.0)])
+    store.add("李四", [trip(8, "常德市", 0.0, 12.5)])
+    store.add("王五", [trip(9, "桃源县", 0.0, 17.5)])
+    path = str(tmp_path / "report.xlsx")
+    start, end = tt.month_range("2024-05")
+    tt.build_rollup_report(store, tt.DEFAULT_CONFIG, start, end, path)
+
+    wb = openpyxl.load_workbook(path, read_only=True)
+    rows = {r[0]: r for r in wb["按人员"].iter_rows(min_row=3, values_only=True)}
+    wb.close()
+    assert rows["张三"][5:] == (70, "柒拾元整")
+    assert rows["李四"][5:] == (12.5, "壹拾贰元伍角")
+    assert rows["王五"][5:] == (17.5, "壹拾柒元伍角")
+    assert rows["合计"][1] == 4
+    assert rows["合计"][5:] == (100, "壹佰元整")
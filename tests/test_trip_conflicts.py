@@ -0,0 +1,51 @@
+import random
+from datetime import datetime
+
+import pytest
+
+import travel_tool as tt
+
+def brute_force(trips):
+    # 两两比较：同一人、区间有交叉即冲突，起止日和终点都相同算重复
+    claims = [t for t in trips if not t.is_return_trip]
+    found = set()
+    for i, a in enumerate(claims):
+        for b in claims[i + 1:]:
+            if a.user != b.user or a.span[1] < b.span[0] or b.span[1] < a.span[0]: continue
+            kind = "duplicate" if a.span == b.span and a.end == b.end else "overlap"
+            found.add((kind, frozenset((a.id, b.id))))
+    return found
+
+def random_trips(rng, n):
+    base = datetime(2021, 9, 1).toordinal()
+    trips = []
+    for i in range(n):
+        fs = base + rng.randrange(30)
+        fe = fs + rng.choice((0, 0, 0, 1, 2, 5))
+        trips.append(tt.Trip(fs, "龙潭", rng.choice("XY"), full_start=fs, full_end=fe, id=i, user=rng.choice("AB")))
+        if fe != fs and rng.random() < 0.5: trips.append(tt.Trip(fe, trips[-1].end, "龙潭", is_return_trip=True, id=1000 + i, user=trips[-1].user))
+    return trips
+
+@pytest.mark.parametrize("seed", range(300))
+def test_find_trip_conflicts_matches_brute_force(seed):
+    rng = random.Random(seed)
+    trips = random_trips(rng, rng.randrange(2, 25))
+    got = {(kind, frozenset((a.id, b.id))) for kind, _, a, b in tt.find_trip_conflicts(trips)}
+    assert got == brute_force(trips)
+
+def test_duplicate_covered_by_longer_claim():
+    day = lambda d: datetime(2021, 9, d).toordinal()
+    trips = [tt.Trip(day(15), "龙潭", "Y", full_start=day(15), full_end=day(15), id=1, user="A"),
+             tt.Trip(day(13), "龙潭", "Z", full_start=day(13), full_end=day(18), id=2, user="A"),
+             tt.Trip(day(15), "龙潭", "Y", full_start=day(15), full_end=day(15), id=7, user="A")]
+    kinds = {(kind, frozenset((a.id, b.id))) for kind, _, a, b in tt.find_trip_conflicts(trips)}
+    assert ("duplicate", frozenset((1, 7))) in kinds
+
+def test_index_conflicts_match_brute_force():
+    rng = random.Random(1)
+    index, added = tt.TripIntervalIndex(), []
+    for t in random_trips(rng, 300):
+        got = {(kind, frozenset((o.id, t.id))) for kind, o in index.conflicts(t.user, t)}
+        assert got == {c for c in brute_force(added + [t]) if t.id in c[1]}
+        index.add(t.user, t)
+        added.append(t)
@@ -0,0 +1,64 @@
+from datetime import datetime
+
+import openpyxl
+import pytest
+
+import travel_tool as tt
+
+USER = {"name": "张三", "phone": "13800000000", "bank": "中国农业银行", "card": "6228480000000000000"}
+FILL_DATE = datetime(2024, 5, 31)
+
+@pytest.fixture
+def templates(tmp_path):
+    # 版式仿照真实表单：合并区域、目标格里原有的文字和公式、不被改写的公式
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = "审核单"
+    ws['A1'] = "报销审核单"
+    for rng in ("A1:O2", "E6:O6", "J10:O10", "C11:O11", "C12:E12", "F12:J12", "K12:M12", "N12:O12"):
+        ws.merge_cells(rng)
+    ws['E6'] = "原单位"
+    ws['J10'] = "=SUM(J4:J9)"
+    ws['A20'] = "=J10*2"
+    audit = tmp_path / "audit.xlsx"
+    wb.save(audit)
+
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = "未派车证明"
+    ws['A1'] = "未派车证明"
+    for rng in ("A1:K1", "B5:D5", "E5:G5", "H5:K5", "B7:K7"):
+        ws.merge_cells(rng)
+    ws['A8'] = "自"
+    ws['B7'] = "原事由"
+    no_car = tmp_path / "no_car.xlsx"
+    wb.save(no_car)
+    return {"audit": str(audit), "no_car": str(no_car)}
+
+def render(templates, kind, cells, backend, path):
+    config = dict(tt.DEFAULT_CONFIG, template_paths=templates, render_backend=backend)
+    tt.fill_template(config, kind, cells, str(path))
+    ws = openpyxl.load_workbook(path).active
+    return {c.coordinate: c.value for row in ws.iter_rows() for c in row if c.value is not None}, \
+        sorted(str(r) for r in ws.merged_cells.ranges)
+
+def cells_for(kind):
+    config = dict(tt.DEFAULT_CONFIG)
+    if kind == "audit":
+        cells = tt.audit_cells(config, USER, [tt.Trip(738900, "龙潭", "桃源县", 0, 30.5)], FILL_DATE)
+    else:
+        day = datetime(2024, 5, 2).toordinal()
+        cells = tt.no_car_cells(config, USER, [tt.Trip(day, "龙潭", "桃源县", 0, 30, True, "巡视 & <检修>", day, day + 2)], FILL_DATE)
+    # 合并区域内非左上角的格子要落到左上角；布尔值、空串一并覆盖
+    return cells + [("G5", "合并内"), ("A3", True), ("B3", False), ("A8", "")]
+
+@pytest.mark.parametrize("kind", ["audit", "no_car"])
+def test_xml_backend_matches_openpyxl(templates, tmp_path, kind):
+    cells = cells_for(kind)
+    expected = render(templates, kind, cells, "openpyxl", tmp_path / f"{kind}_openpyxl.xlsx")
+    actual = render(templates, kind, cells, "xml", tmp_path / f"{kind}_xml.xlsx")
+    assert actual == expected
+
+def test_bool_cells_stay_boolean(templates, tmp_path):
+    values, _ = render(templates, "no_car", [("A3", True), ("B3", False)], "xml", tmp_path / "b.xlsx")
+    assert values["A3"] is True and values["B3"] is False
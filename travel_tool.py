@@ -1,12 +1,55 @@
+import time
+_T_START = time.perf_counter() # 冷启动计时起点
 import tkinter as tk
-from tkinter import ttk, messagebox
+from tkinter import ttk, messagebox, filedialog
 import json
 import os
+import logging
+import sqlite3
+import sys
+import csv
+import argparse
+import hashlib
+import io
+import pickle
+import re
+import struct
+import zlib
+import zipfile
+import posixpath
+import xml.etree.ElementTree as ET
+import threading
+import bisect
+import heapq
+import queue
+import weakref
+from copy import copy, deepcopy
+from operator import attrgetter
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-import openpyxl
-from openpyxl.cell.cell import MergedCell
+from decimal import Decimal, ROUND_HALF_UP
+_T_IMPORTED = time.perf_counter() # 模块导入结束
+
+# openpyxl 是启动时最重的导入，推迟到第一次真正用到时再加载 (见 _import_openpyxl)
+openpyxl = MergedCell = MultiCellRange = MergedCellRange = None
+coordinate_to_tuple = get_column_letter = column_index_from_string = None
+
+def _import_openpyxl():
+    global openpyxl, MergedCell, MultiCellRange, MergedCellRange, coordinate_to_tuple, get_column_letter, column_index_from_string
+    if openpyxl is not None: return
+    from openpyxl.cell.cell import MergedCell
+    from openpyxl.utils.cell import coordinate_to_tuple, get_column_letter, column_index_from_string
+    from openpyxl.worksheet.cell_range import MultiCellRange
+    from openpyxl.worksheet.merge import MergedCellRange
+    import openpyxl as module
+    openpyxl = module # 最后赋值：其他线程看到 openpyxl 非空时其余名字已就绪
 
 CONFIG_FILE = "config.json"
+DB_FILE = "trips.db"
+LOG_DIR = "logs"
+log = logging.getLogger("travel_tool")
 DEFAULT_CONFIG = {
     "users": [],
     "current_user_index": -1,
@@ -20,15 +63,26 @@ DEFAULT_CONFIG = {
         "expense": "差旅费报销单模板.xlsx",
         "audit": "报销审核单模板.xlsx",
         "no_car": "未派车证明模板.xlsx"
-    }
+    },
+    "render_backend": "openpyxl", # 审核单/未派车证明的渲染方式: openpyxl 或 xml (直接改写 xlsx 内部 XML)
+    "nocar_output": "files" # 未派车证明: files 每条行程一个文件，workbook 合并为一个多工作表文件
 }
+PARALLEL_MIN_JOBS = 8 # 未派车证明达到这个数量才值得开进程池
+
+def to_fen(num):
+    # 金额统一按分四舍五入 (规则读进来是 float，70.0 也要当整数元处理)
+    return Decimal(str(num)).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+
+def fmt_amount(num):
+    return format(to_fen(num).normalize(), 'f') # 70.0 -> "70", 12.50 -> "12.5"
 
 def num_to_cn_amount(num):
-    if num == 0: return "零元整"
+    amount = to_fen(num)
+    if amount == 0: return "零元整"
     units = ["", "拾", "佰", "仟"]
     big_units = ["", "万", "亿"]
-    num_str = str(int(num))
-    fraction = str(round(num - int(num), 2))[2:]
+    num_str = str(int(amount))
+    jiao, fen = divmod(int(amount * 100) % 100, 10)
     result = ""
     length = len(num_str)
     for i, digit in enumerate(num_str):
@@ -37,81 +91,1703 @@ def num_to_cn_amount(num):
         if (length - 1 - i) % 4 == 0: result += big_units[(length - 1 - i) // 4]
     result = result.replace("零零", "零").strip("零")
     result += "元"
-    if len(fraction) > 0:
-        jiao = int(fraction[0])
-        fen = int(fraction[1]) if len(fraction) > 1 else 0
+    if jiao or fen:
         if jiao > 0: result += "零壹贰叁肆伍陆柒捌玖"[jiao] + "角"
         if fen > 0: result += "零壹贰叁肆伍陆柒捌玖"[fen] + "分"
     else: result += "整"
     return result
 
+def load_config(path=CONFIG_FILE):
+    if not os.path.exists(path): return DEFAULT_CONFIG
+    try:
+        with open(path, 'r', encoding='utf-8') as f: return json.load(f)
+    except: return DEFAULT_CONFIG
+
+# --- 核心：生成过程计量 ---
+# 每份文档一个 GenerationMetrics：分阶段计时 (template/fill/insert_rows/save) 和计数
+# (cells_written/merged_redirects/skipped_writes/write_errors/bytes_saved)。
+# render_document 把它挂到当前线程上，写入函数用 current_metrics() 取到，结果以字典形式返回，
+# 这样进程池里渲染的文档也能汇总回来。
+class GenerationMetrics:
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name):
+        t0 = time.perf_counter()
+        try: yield
+        finally:
+            st = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0})
+            st["seconds"] += time.perf_counter() - t0
+            st["calls"] += 1
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, data):
+        for name, st in data.get('stages', {}).items():
+            mine = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0})
+            mine["seconds"] += st["seconds"]
+            mine["calls"] += st["calls"]
+        for name, n in data.get('counters', {}).items(): self.count(name, n)
+
+    def to_dict(self):
+        return {"stages": {k: {"seconds": round(v["seconds"], 6), "calls": v["calls"]} for k, v in self.stages.items()},
+                "counters": dict(self.counters)}
+
+_ACTIVE = threading.local()
+
+def current_metrics():
+    # 不在 render_document 里调用时给一个用完即弃的实例，调用方不用判空
+    m = getattr(_ACTIVE, 'metrics', None)
+    return m if m is not None else GenerationMetrics()
+
+@contextmanager
+def profiling(enabled, log_dir=LOG_DIR, tag="run"):
+    # 可选的 cProfile + tracemalloc：只统计当前线程/进程，结果写进 yield 出去的字典
+    result = {}
+    if not enabled:
+        yield result
+        return
+    import cProfile, pstats, tracemalloc
+    os.makedirs(log_dir, exist_ok=True)
+    prof = cProfile.Profile()
+    tracemalloc.start()
+    prof.enable()
+    try: yield result
+    finally:
+        prof.disable()
+        snapshot = tracemalloc.take_snapshot()
+        result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        result['top_allocations'] = [str(s) for s in snapshot.statistics('lineno')[:10]]
+        result['profile_file'] = os.path.join(log_dir, f"{tag}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.prof")
+        prof.dump_stats(result['profile_file'])
+        stream = io.StringIO()
+        pstats.Stats(prof, stream=stream).sort_stats('cumulative').print_stats(15)
+        result['top_functions'] = stream.getvalue().splitlines()
+
+def write_run_report(report, log_dir=LOG_DIR):
+    # 每次生成追加一行 JSON 到 generation.jsonl，便于按时间比对找性能回退
+    try:
+        os.makedirs(log_dir, exist_ok=True)
+        with open(os.path.join(log_dir, "generation.jsonl"), 'a', encoding='utf-8') as f:
+            f.write(json.dumps(report, ensure_ascii=False, default=str) + "\n")
+    except OSError as e: log.warning("写入生成日志失败: %s", e)
+
+# --- 核心：安全写入 (防崩版 + 合并单元格索引) ---
+# 每张工作表预先建立 坐标 -> 合并区域左上角 的字典，写合并单元格和写普通单元格一样是 O(1)。
+# 插入行必须走 insert_rows，这样合并区域会跟着平移，索引也同步更新。
+class SheetWriter:
+    def __init__(self, ws):
+        _import_openpyxl()
+        self.ws = ws
+        self.metrics = current_metrics()
+        self._anchors = {}
+        self._rebuild_index()
+
+    def _rebuild_index(self):
+        anchors = {}
+        for rng in self.ws.merged_cells.ranges:
+            anchor = (rng.min_row, rng.min_col)
+            for row in range(rng.min_row, rng.max_row + 1):
+                for col in range(rng.min_col, rng.max_col + 1):
+                    anchors[(row, col)] = anchor
+        self._anchors = anchors
+
+    def write(self, coord, value):
+        try:
+            row, col = coordinate_to_tuple(coord)
+            anchor = self._anchors.get((row, col))
+            if anchor:
+                # 合并区域内任意格都写到左上角“父节点”
+                self.ws.cell(row=anchor[0], column=anchor[1]).value = value
+                if anchor != (row, col): self.metrics.count("merged_redirects")
+            elif isinstance(self.ws._cells.get((row, col)), MergedCell):
+                # 是 MergedCell 却不在任何合并区域里 (模板本身损坏)：跳过写入，记警告，防止崩溃
+                log.warning("Skipped writing to broken merged cell %s", coord)
+                self.metrics.count("skipped_writes")
+                return
+            else:
+                self.ws.cell(row=row, column=col).value = value
+            self.metrics.count("cells_written")
+        except Exception as e:
+            # 最后一道防线：任何写入错误都捕获，不让程序崩溃
+            log.error("Error writing to %s: %s", coord, e)
+            self.metrics.count("write_errors")
+
+    def insert_rows(self, idx, amount=1):
+        # openpyxl 的 insert_rows 只移动单元格，不移动合并区域；这里补上：
+        # 整体在插入点以下的区域下移，跨越插入点的区域向下扩展 (与 Excel 行为一致)
+        self.ws.insert_rows(idx, amount)
+        ranges, grown = [], []
+        for rng in self.ws.merged_cells.ranges:
+            if rng.min_row >= idx: rng.shift(row_shift=amount)
+            elif rng.max_row >= idx:
+                rng.expand(down=amount)
+                grown.append(rng)
+            ranges.append(rng)
+        self.ws.merged_cells = MultiCellRange(ranges)
+        for rng in grown: rng.format() # 为扩展出来的格子补建 MergedCell
+        # 行高也不会跟着移动，从下往上挪
+        dims = self.ws.row_dimensions
+        for r in sorted((r for r in dims if r >= idx), reverse=True):
+            d = dims.pop(r)
+            d.index = r + amount
+            dims[r + amount] = d
+        self._rebuild_index()
+
+    def expand_rows(self, template_row, amount):
+        # 一次性在 template_row 下方插入 amount 行 (下方的合计/银行行一起下移)，
+        # 新行照抄样板行的单元格样式、边框、行高和单行合并布局
+        if amount <= 0: return
+        ws = self.ws
+        self.metrics.count("rows_inserted", amount)
+        self.insert_rows(template_row + 1, amount)
+        # 样板行的 MergedCell 已带着合并后的边框，直接克隆单元格，省掉 openpyxl 重新计算合并边框
+        cells = [(c.column, isinstance(c, MergedCell), c._style) for c in ws[template_row]]
+        merges = [rng for rng in ws.merged_cells.ranges if rng.min_row == rng.max_row == template_row]
+        height = ws.row_dimensions[template_row].height if template_row in ws.row_dimensions else None
+        for row in range(template_row + 1, template_row + 1 + amount):
+            for col, merged, style in cells:
+                cell = MergedCell(ws, row=row, column=col) if merged else ws.cell(row=row, column=col)
+                cell._style = copy(style)
+                ws._cells[(row, col)] = cell
+            if height is not None: ws.row_dimensions[row].height = height
+            for rng in merges:
+                mcr = MergedCellRange(ws, f"{get_column_letter(rng.min_col)}{row}:{get_column_letter(rng.max_col)}{row}")
+                ws.merged_cells.ranges.add(mcr)
+                for col in range(mcr.min_col, mcr.max_col + 1): self._anchors[(row, col)] = (row, mcr.min_col)
+
+_WRITERS = weakref.WeakKeyDictionary()
+
+def safe_write(ws, coord, value):
+    # 兼容旧接口：同一张表复用同一个索引
+    writer = _WRITERS.get(ws)
+    if writer is None: writer = _WRITERS[ws] = SheetWriter(ws)
+    writer.write(coord, value)
+
+# --- 核心：检查文件是否被占用 ---
+def check_file_lock(filename):
+    if os.path.exists(filename):
+        try:
+            # 尝试以追加模式打开文件，如果被 Excel 占用会报错
+            with open(filename, 'a'):
+                pass
+        except PermissionError:
+            return False
+    return True
+
+# --- 核心：模板缓存 ---
+# 每个模板只解析一次，之后用 pickle 快照复制出独立的工作簿 (比重新解析 xlsx 快一个数量级)。
+# 文件 mtime/大小变化时重新读取，内容哈希也变了才重新解析。
+class TemplateCache:
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, path):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        stat_key = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            e = self._entries.get(path)
+            if e and e['stat'] == stat_key: return e
+            with open(path, 'rb') as f: data = f.read()
+            digest = hashlib.sha1(data).hexdigest()
+            if e and e['sha1'] == digest:
+                e['stat'] = stat_key
+                return e
+            e = {'stat': stat_key, 'sha1': digest, 'data': data}
+            self._entries[path] = e
+            return e
+
+    def _derived(self, path, key, build):
+        # 解析结果按需生成：只用 XML 渲染的模板不必走一遍 openpyxl 解析
+        e = self._entry(path)
+        if key not in e:
+            value = build(e['data'])
+            with self._lock: e.setdefault(key, value)
+        return e[key]
+
+    def workbook(self, path):
+        snapshot = self._derived(path, 'snapshot', _workbook_snapshot)
+        if snapshot is None: return openpyxl.load_workbook(io.BytesIO(self._entry(path)['data']))
+        wb = pickle.loads(snapshot)
+        for ws in wb.worksheets:
+            # 行高/列宽字典是 defaultdict 子类，pickle 后工厂函数会丢失，这里接回去
+            for holder, factory in ((ws.row_dimensions, ws._add_row), (ws.column_dimensions, ws._add_column)):
+                holder.worksheet, holder.default_factory = ws, factory
+        return wb
+
+    def xml_template(self, path):
+        return self._derived(path, 'xml', XmlTemplate)
+
+    def digest(self, path):
+        return self._entry(path)['sha1']
+
+    def clear(self):
+        with self._lock: self._entries.clear()
+
+def _workbook_snapshot(data):
+    _import_openpyxl()
+    wb = openpyxl.load_workbook(io.BytesIO(data))
+    try: return pickle.dumps(wb, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception: return None # 含无法序列化的对象时退回到从内存字节重新解析
+
+# --- 核心：XML 直改渲染 ---
+# 适用于不需要插行的固定版式 (审核单、未派车证明)：不建 openpyxl 对象模型，
+# 只改写活动工作表 sheetData 里目标 <c> 元素，其余 zip 成员按原压缩字节照搬。
+NS_MAIN = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+NS_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+NS_PKG_REL = "http://schemas.openxmlformats.org/package/2006/relationships"
+RE_ROW = re.compile(r'<row\b[^>]*?(?:/>|>.*?</row>)', re.S)
+RE_CELL = re.compile(r'<c\b[^>]*?(?:/>|>.*?</c>)', re.S)
+RE_REF = re.compile(r'\br="([A-Z]+)(\d+)"')
+RE_ROW_NUM = re.compile(r'\br="(\d+)"')
+RE_STYLE = re.compile(r'\bs="(\d+)"')
+RE_MERGE = re.compile(r'<mergeCell\b[^>]*?\bref="([A-Z]+\d+):([A-Z]+\d+)"')
+RE_CALC_PR = re.compile(r'<calcPr\b[^>]*?/?>')
+# workbook.xml 中 calcPr 之后的元素 (按 schema 顺序)，缺 calcPr 时插到它们前面
+CALC_PR_FOLLOWERS = ("<oleSize", "<customWorkbookViews", "<pivotCaches", "<smartTagPr", "<smartTagTypes",
+                     "<webPublishing", "<fileRecoveryPr", "<webPublishObjects", "<extLst", "</workbook>")
+
+def _xml_cell(ref, style, value):
+    s_attr = f' s="{style}"' if style else ""
+    if value is None or value == "": return f'<c r="{ref}"{s_attr}/>'
+    if isinstance(value, bool): return f'<c r="{ref}"{s_attr} t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return f'<c r="{ref}"{s_attr}><v>{value!r}</v></c>'
+    text = str(value).replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    space = ' xml:space="preserve"' if text != text.strip() else ""
+    return f'<c r="{ref}"{s_attr} t="inlineStr"><is><t{space}>{text}</t></is></c>'
+
+class XmlTemplate:
+    def __init__(self, data):
+        _import_openpyxl() # 只用到坐标换算
+        self.data = data
+        with zipfile.ZipFile(io.BytesIO(data)) as z:
+            names = set(z.namelist())
+            root_rels = ET.fromstring(z.read("_rels/.rels"))
+            wb_part = next(r.get("Target") for r in root_rels.iter(f"{{{NS_PKG_REL}}}Relationship") if r.get("Type").endswith("/officeDocument")).lstrip("/")
+            wb_rels_part = posixpath.join(posixpath.dirname(wb_part), "_rels", posixpath.basename(wb_part) + ".rels")
+            wb_xml = z.read(wb_part).decode("utf-8")
+            wb_rels_xml = z.read(wb_rels_part).decode("utf-8")
+            # 活动工作表 = workbookView.activeTab 指向的 sheet (与 openpyxl 的 wb.active 一致)
+            wb_root = ET.fromstring(wb_xml)
+            view = wb_root.find(f"{{{NS_MAIN}}}bookViews/{{{NS_MAIN}}}workbookView")
+            active = int(view.get("activeTab", 0)) if view is not None else 0
+            sheets = wb_root.findall(f"{{{NS_MAIN}}}sheets/{{{NS_MAIN}}}sheet")
+            rid = sheets[min(active, len(sheets) - 1)].get(f"{{{NS_REL}}}id")
+            target = next(r.get("Target") for r in ET.fromstring(wb_rels_xml) if r.get("Id") == rid)
+            self.sheet_part = target.lstrip("/") if target.startswith("/") else posixpath.normpath(posixpath.join(posixpath.dirname(wb_part), target))
+            sheet_xml = z.read(self.sheet_part).decode("utf-8")
+            content_types = z.read("[Content_Types].xml").decode("utf-8")
+
+        self.anchors = {}
+        for a, b in RE_MERGE.findall(sheet_xml):
+            (r1, c1), (r2, c2) = coordinate_to_tuple(a), coordinate_to_tuple(b)
+            for row in range(r1, r2 + 1):
+                for col in range(c1, c2 + 1): self.anchors[(row, col)] = (r1, c1)
+
+        # sheetData 切成 [头, 行1, 行2, ..., 尾]，渲染时只重写目标行
+        m = re.search(r'<sheetData\s*/>|<sheetData\b[^>]*>(.*?)</sheetData>', sheet_xml, re.S)
+        if m is None: raise ValueError(f"模板 {self.sheet_part} 结构不受支持，请改用 openpyxl 渲染")
+        body_start = m.start(1) if m.group(1) is not None else None
+        self.head = sheet_xml[:body_start] if body_start is not None else sheet_xml[:m.start()] + "<sheetData>"
+        self.tail = sheet_xml[m.end(1):] if body_start is not None else "</sheetData>" + sheet_xml[m.end():]
+        self.rows, self.row_index = [], {}
+        for rm in RE_ROW.finditer(m.group(1) or ""):
+            num = RE_ROW_NUM.search(rm.group(0)[:rm.group(0).index(">")])
+            if num is None: raise ValueError("模板中存在未标注行号的 <row>，请改用 openpyxl 渲染")
+            self.row_index[int(num.group(1))] = len(self.rows)
+            self.rows.append((int(num.group(1)), rm.group(0)))
+
+        # 与模板无关、每次都一样的改动提前算好：去掉 calcChain，打开时全部重算公式
+        self.static = {}
+        calc_chain = [n for n in names if n.endswith("calcChain.xml")]
+        for n in calc_chain: self.static[n] = None
+        if calc_chain:
+            self.static["[Content_Types].xml"] = re.sub(r'<Override\b[^>]*calcChain[^>]*/>', "", content_types).encode("utf-8")
+            self.static[wb_rels_part] = re.sub(r'<Relationship\b[^>]*calcChain[^>]*/>', "", wb_rels_xml).encode("utf-8")
+        calc = RE_CALC_PR.search(wb_xml)
+        if calc:
+            tag = re.sub(r'\s+fullCalcOnLoad="[^"]*"', "", calc.group(0))
+            tag = tag[:-2] + ' fullCalcOnLoad="1"/>' if tag.endswith("/>") else tag[:-1] + ' fullCalcOnLoad="1">'
+            wb_xml = wb_xml[:calc.start()] + tag + wb_xml[calc.end():]
+        else:
+            pos = min(i for i in (wb_xml.find(t) for t in CALC_PR_FOLLOWERS) if i >= 0)
+            wb_xml = wb_xml[:pos] + '<calcPr fullCalcOnLoad="1"/>' + wb_xml[pos:]
+        self.static[wb_part] = wb_xml.encode("utf-8")
+
+    def _patch_row(self, row_xml, row, values):
+        # values: {列号: 值}，按列序替换已有 <c> 或插入新 <c>
+        end = row_xml.index(">")
+        open_tag = re.sub(r'\s+spans="[^"]*"', "", row_xml[:end + 1])
+        if open_tag.endswith("/>"): open_tag, body = open_tag[:-2] + ">", ""
+        else: body = row_xml[end + 1:-len("</row>")]
+        pending = sorted(values.items())
+        out, pos = [], 0
+        for cm in RE_CELL.finditer(body):
+            cell = cm.group(0)
+            ref = RE_REF.search(cell[:cell.index(">") + 1])
+            col = column_index_from_string(ref.group(1))
+            out.append(body[pos:cm.start()])
+            pos = cm.start()
+            while pending and pending[0][0] < col:
+                c, v = pending.pop(0)
+                out.append(_xml_cell(f"{get_column_letter(c)}{row}", None, v))
+            if pending and pending[0][0] == col:
+                # 保留原单元格的样式编号，丢掉原来的值/公式
+                style = RE_STYLE.search(cell[:cell.index(">") + 1])
+                out.append(_xml_cell(ref.group(1) + ref.group(2), style.group(1) if style else None, pending.pop(0)[1]))
+                pos = cm.end()
+        out.append(body[pos:])
+        out.extend(_xml_cell(f"{get_column_letter(c)}{row}", None, v) for c, v in pending)
+        return open_tag + "".join(out) + "</row>"
+
+    def render(self, cells, path):
+        metrics = current_metrics()
+        with metrics.stage("fill"):
+            targets = {}
+            for coord, value in cells:
+                pos = coordinate_to_tuple(coord)
+                row, col = self.anchors.get(pos, pos) # 合并区域写到左上角
+                if (row, col) != pos: metrics.count("merged_redirects")
+                targets.setdefault(row, {})[col] = value
+            metrics.count("cells_written", len(cells))
+            parts = [self.head]
+            pending = sorted(r for r in targets if r not in self.row_index)
+            for num, row_xml in self.rows:
+                while pending and pending[0] < num:
+                    r = pending.pop(0)
+                    parts.append(self._patch_row(f'<row r="{r}"/>', r, targets[r]))
+                parts.append(self._patch_row(row_xml, num, targets[num]) if num in targets else row_xml)
+            parts.extend(self._patch_row(f'<row r="{r}"/>', r, targets[r]) for r in pending)
+            parts.append(self.tail)
+            members = dict(self.static)
+            members[self.sheet_part] = "".join(parts).encode("utf-8")
+        with metrics.stage("save"):
+            with open(path, 'wb') as f: f.write(_zip_rewrite(self.data, members))
+
+def _zip_rewrite(data, replace):
+    # 重新打包 zip：replace 里的成员 (值为 None 表示删除) 重新压缩，其余成员连同本地文件头原样拷贝
+    out, central = io.BytesIO(), []
+    with zipfile.ZipFile(io.BytesIO(data)) as z:
+        for info in z.infolist():
+            name = info.orig_filename
+            if name in replace and replace[name] is None: continue
+            offset = out.tell()
+            name_bytes = name.encode("utf-8" if info.flag_bits & 0x800 else "cp437")
+            if name in replace:
+                raw = replace[name]
+                comp = zlib.compressobj(6, zlib.DEFLATED, -15)
+                payload = comp.compress(raw) + comp.flush()
+                crc, csize, usize, method, flags, extra = zlib.crc32(raw), len(payload), len(raw), zipfile.ZIP_DEFLATED, info.flag_bits & 0x800, b""
+                y, mo, d, h, mi, sec = info.date_time
+                dos_time, dos_date = h << 11 | mi << 5 | sec // 2, (y - 1980) << 9 | mo << 5 | d
+                out.write(struct.pack("<4s2B4HL2L2H", b"PK\x03\x04", 20, 0, flags, method, dos_time, dos_date, crc, csize, usize, len(name_bytes), 0))
+                out.write(name_bytes)
+                out.write(payload)
+            else:
+                hdr = data[info.header_offset:info.header_offset + 30]
+                n, m = struct.unpack("<2H", hdr[26:30])
+                end = info.header_offset + 30 + n + m + info.compress_size
+                if info.flag_bits & 0x08: end += 16 if data[end:end + 4] == b"PK\x07\x08" else 12 # 数据描述符
+                out.write(data[info.header_offset:end])
+                crc, csize, usize, method, flags, extra = info.CRC, info.compress_size, info.file_size, info.compress_type, info.flag_bits, info.extra
+                y, mo, d, h, mi, sec = info.date_time
+                dos_time, dos_date = h << 11 | mi << 5 | sec // 2, (y - 1980) << 9 | mo << 5 | d
+            central.append(struct.pack("<4s4B4HL2L5H2L", b"PK\x01\x02", info.create_version, info.create_system, 20, 0,
+                                       flags, method, dos_time, dos_date, crc, csize, usize, len(name_bytes), len(extra),
+                                       len(info.comment), 0, info.internal_attr, info.external_attr, offset) + name_bytes + extra + info.comment)
+    cd_offset = out.tell()
+    for entry in central: out.write(entry)
+    out.write(struct.pack("<4s4H2LH", b"PK\x05\x06", 0, 0, len(central), len(central), out.tell() - cd_offset, cd_offset, 0))
+    return out.getvalue()
+
+TEMPLATE_CACHE = TemplateCache()
+
+# --- 核心：行程记录 ---
+# 一条报销行一个 Trip：__slots__ 没有实例字典，日期存 toordinal() 整数，排序、比较、区间判断都是整数运算；
+# 需要年月日时再通过 date / full_start_date / full_end_date 属性换回 datetime。返程行没有 full_* 日期。
+class Trip:
+    __slots__ = ("id", "user", "day", "start", "end", "food", "misc", "nocar", "reason", "full_start", "full_end", "is_return_trip")
+    FIELDS = __slots__
+
+    def __init__(self, day, start, end, food=0.0, misc=0.0, nocar=False, reason="", full_start=None, full_end=None,
+                 is_return_trip=False, id=None, user=None):
+        self.id, self.user, self.day, self.start, self.end = id, user, day, start, end
+        self.food, self.misc, self.nocar, self.reason = food, misc, nocar, reason
+        self.full_start, self.full_end, self.is_return_trip = full_start, full_end, is_return_trip
+
+    @property
+    def date(self):
+        return datetime.fromordinal(self.day)
+
+    @property
+    def full_start_date(self):
+        return datetime.fromordinal(self.full_start) if self.full_start is not None else None
+
+    @property
+    def full_end_date(self):
+        return datetime.fromordinal(self.full_end) if self.full_end is not None else None
+
+    @property
+    def amount(self):
+        return self.food + self.misc
+
+    @property
+    def span(self):
+        # 这次出差覆盖的 [起, 止] 日 (返程行只有自己这一天)
+        fs = self.day if self.full_start is None else self.full_start
+        return fs, fs if self.full_end is None else self.full_end
+
+    def to_dict(self):
+        return {k: getattr(self, k) for k in self.FIELDS}
+
+    @classmethod
+    def from_dict(cls, raw):
+        # 清单里的日期是字符串，金额可能是文本
+        day = lambda k: parse_date(raw[k]).toordinal() if raw.get(k) not in (None, "") else None
+        return cls(day('date'), raw.get('start', ""), raw.get('end', ""), float(raw.get('food') or 0), float(raw.get('misc') or 0),
+                   parse_bool(raw.get('nocar', False)), raw.get('reason') or "差旅", day('full_start_date'), day('full_end_date'),
+                   parse_bool(raw.get('is_return_trip', False)), raw.get('id'), raw.get('user'))
+
+    def __repr__(self):
+        return f"Trip({self.date:%Y-%m-%d} {self.start}->{self.end} {self.amount:g})"
+
+by_day = attrgetter('day') # 排序键
+
+# --- 核心：无界面生成引擎 (GUI 与命令行批量共用) ---
+def parse_date(value):
+    if isinstance(value, datetime): return value
+    return datetime.strptime(str(value).strip()[:10], "%Y-%m-%d")
+
+def parse_bool(value):
+    if isinstance(value, bool): return value
+    return str(value).strip().lower() in ("1", "true", "yes", "y", "是")
+
+def trips_total(trips):
+    return sum([t.food + t.misc for t in trips])
+
+# --- 核心：计价表 ---
+# rules 编译成 (目的地类别, 行程形态) -> (伙食, 杂费) 的查表；规则改了重新编译一次，
+# 之后每条行程只是一次字典查找，一年的历史行程重算也只要几毫秒。
+DEST_CLASSES = ("local", "county", "city")
+TRIP_SHAPES = ("same_day", "outbound", "return")
+
+def classify_destination(place, station):
+    if place in ("辖区", "辖区线路"): return "local"
+    return "county" if place == station['county'] else "city"
+
+def trip_destination(t):
+    # 返程的“远端”是出发地
+    return t.start if t.is_return_trip else t.end
+
+def trip_shape(t):
+    if t.is_return_trip: return "return"
+    return "outbound" if t.full_start is not None and t.full_end is not None and t.full_end != t.full_start else "same_day"
+
+class PricingTable:
+    def __init__(self, rules, station):
+        self.station = station
+        self.table = {}
+        for shape in TRIP_SHAPES: self.table[("local", shape)] = (float(rules['local']['food']), float(rules['local']['misc']))
+        for cls in ("county", "city"):
+            r = rules[cls]
+            self.table[(cls, "same_day")] = (0.0, float(r['misc_round_trip']))
+            self.table[(cls, "outbound")] = self.table[(cls, "return")] = (0.0, float(r['misc_one_way']))
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['rules'], config['station_info'])
+
+    def key(self, t):
+        return classify_destination(trip_destination(t), self.station), trip_shape(t)
+
+    def price(self, t):
+        return self.table[self.key(t)]
+
+    def price_many(self, trips):
+        # 批量计价：返回与 trips 等长的 (伙食, 杂费) 列表
+        table, key = self.table, self.key
+        return [table[key(t)] for t in trips]
+
+    def apply(self, trips):
+        # 就地写回金额，返回新的合计
+        for t, (food, misc) in zip(trips, self.price_many(trips)): t.food, t.misc = food, misc
+        return trips_total(trips)
+
+def trips_from_dicts(config, raws, pricing=None):
+    # 清单/服务请求里的行程：没填 food、misc 的按规则计价，填了的照用
+    trips = [Trip.from_dict(raw) for raw in raws]
+    unpriced = [t for t, raw in zip(trips, raws) if raw.get('food') in (None, "") and raw.get('misc') in (None, "")]
+    if unpriced: (pricing or PricingTable.from_config(config)).apply(unpriced)
+    return trips
+
+def make_trip_legs(config, start_place, end_place, start_date, end_date, nocar=False, reason="", pricing=None):
+    # 一次出差拆成报销行：辖区线路一行；当天往返一行；跨天为去程+返程两行。金额由计价表填写
+    home = config['station_info']['name'].replace("供电所", "")
+    fs, fe = start_date.toordinal(), end_date.toordinal()
+    if end_place in ("辖区", "辖区线路"):
+        legs = [Trip(fs, home, "辖区", nocar=nocar, reason=reason, full_start=fs, full_end=fe)]
+    else:
+        clean_start = start_place.replace("本所", home)
+        legs = [Trip(fs, clean_start, end_place, nocar=nocar, reason=reason, full_start=fs, full_end=fe)]
+        if fe != fs: legs.append(Trip(fe, end_place, clean_start, reason=reason, is_return_trip=True))
+    (pricing or PricingTable.from_config(config)).apply(legs)
+    return legs
+
+# --- 核心：行程区间索引 (重复/重叠检查) ---
+# 每条出差按 [出发日, 返回日] 记一个闭区间 (Trip.span，toordinal 整数)，返程行算在去程里不单独占区间。
+# 每人一张按起点排序的表，同时记下最长区间的天数，查询时二分出起点落在 [新起点-最长天数, 新终点] 的
+# 少数几条再逐条比较，O(log n)。终点、起止日都相同算“重复”，其余日期有交叉算“重叠”。
+def describe_trip(t):
+    fs, fe = t.span
+    span = datetime.fromordinal(fs).strftime("%Y-%m-%d") + ("" if fe == fs else datetime.fromordinal(fe).strftime("~%m-%d"))
+    return f"{span} {t.start}->{t.end}"
+
+class TripIntervalIndex:
+    def __init__(self, trips=()):
+        self.users = {} # 姓名 -> {"starts": [...], "items": [(起, 止, 序号, 行程)], "longest": 天数}
+        self._seq = 0
+        for t in trips: self.add(t.user, t)
+
+    def add(self, user, t):
+        if t.is_return_trip: return
+        fs, fe = t.span
+        u = self.users.setdefault(user, {"starts": [], "items": [], "longest": 0})
+        self._seq += 1
+        i = bisect.bisect_right(u['starts'], fs)
+        u['starts'].insert(i, fs)
+        u['items'].insert(i, (fs, fe, self._seq, t))
+        u['longest'] = max(u['longest'], fe - fs)
+
+    def remove(self, user, t):
+        u = self.users.get(user)
+        if u is None or t.is_return_trip: return
+        fs = t.span[0]
+        lo, hi = bisect.bisect_left(u['starts'], fs), bisect.bisect_right(u['starts'], fs)
+        for i in range(lo, hi):
+            if u['items'][i][3] is t or (t.id is not None and u['items'][i][3].id == t.id):
+                del u['starts'][i], u['items'][i]
+                return
+
+    def conflicts(self, user, t):
+        # 返回 [("duplicate" | "overlap", 已有行程)]
+        u = self.users.get(user)
+        if u is None or t.is_return_trip: return []
+        fs, fe = t.span
+        lo, hi = bisect.bisect_left(u['starts'], fs - u['longest']), bisect.bisect_right(u['starts'], fe)
+        found = []
+        for s, e, _, other in u['items'][lo:hi]:
+            if e < fs or other is t: continue
+            same = (s, e, other.end) == (fs, fe, t.end)
+            found.append(("duplicate" if same else "overlap", other))
+        return found
+
+def find_trip_conflicts(trips):
+    # 一遍扫描整段历史：按人、按起点排序，小顶堆按止日保存还没结束的区间，
+    # 每条和堆里所有仍未结束的区间逐一比较 (被长区间盖住的两条重复也能查出)。返回 [(类别, 姓名, 前一条, 后一条)]
+    by_user = {}
+    for t in trips:
+        if not t.is_return_trip: by_user.setdefault(t.user, []).append((*t.span, t))
+    found = []
+    for user, items in by_user.items():
+        items.sort(key=lambda x: (x[0], x[1]))
+        open_items = [] # (止, 序号, 行程)
+        for seq, (fs, fe, t) in enumerate(items):
+            while open_items and open_items[0][0] < fs: heapq.heappop(open_items)
+            for _, _, prev in sorted(open_items, key=lambda x: x[1]):
+                same = prev.span == (fs, fe) and prev.end == t.end
+                found.append(("duplicate" if same else "overlap", user, prev, t))
+            heapq.heappush(open_items, (fe, seq, t))
+    return found
+
+CONFLICT_NAMES = {"duplicate": "重复", "overlap": "时间重叠"}
+
+def _unique_path(path, used):
+    # 同一天出发、同一终点的两条行程会得到同名文件，后者加 _2、_3 区分
+    base, ext = os.path.splitext(path)
+    n = 2
+    while path in used:
+        path = f"{base}_{n}{ext}"
+        n += 1
+    used.add(path)
+    return path
+
+RE_UNSAFE_NAME = re.compile(r'[\\/:*?"<>|]')
+
+def clean_name(text):
+    # 姓名、地名拼进文件名前去掉路径分隔符和 Windows 文件名非法字符
+    return RE_UNSAFE_NAME.sub("_", str(text))
+
+def plan_documents(user, trips, fill_date, out_dir="", nocar_output="files"):
+    # 只做规划不读模板：返回每份待生成文档的描述，渲染可以放在任意进程里执行
+    trips = sorted(trips, key=by_day)
+    name = clean_name(user['name'])
+    file_suffix = f"{name}_{fill_date.strftime('%m%d')}"
+    jobs = [{"kind": "expense", "path": os.path.join(out_dir, f"1_差旅费报销单_{file_suffix}.xlsx"), "trips": trips},
+            {"kind": "audit", "path": os.path.join(out_dir, f"2_报销审核单_{file_suffix}.xlsx"), "trips": trips}]
+    nocar_trips = [t for t in trips if t.nocar]
+    if nocar_output == "workbook":
+        if nocar_trips: jobs.append({"kind": "no_car_book", "path": os.path.join(out_dir, f"3_未派车_{file_suffix}.xlsx"), "trips": nocar_trips})
+        return jobs
+    used = set()
+    for t in nocar_trips:
+        fs = datetime.fromordinal(t.span[0])
+        path = _unique_path(os.path.join(out_dir, f"3_未派车_{name}_{fs.strftime('%m%d')}_至_{clean_name(t.end)}.xlsx"), used)
+        jobs.append({"kind": "no_car", "path": path, "trips": [t]})
+    return jobs
+
+def render_expense(config, user, trips, fill_date, path):
+    total_money = trips_total(trips)
+    min_date, max_date = trips[0].date, trips[-1].date
+    date_desc = f"自 {min_date.year} 年 {min_date.month} 月 {min_date.day} 日 至 {max_date.year} 年 {max_date.month} 月 {max_date.day} 日 计 {(max_date - min_date).days + 1} 天"
+    metrics = current_metrics()
+    with metrics.stage("template"): wb = TEMPLATE_CACHE.workbook(config['template_paths']['expense'])
+    w = SheetWriter(wb.active)
+    curr_row = 8
+    orig_rows = 6
+    extra = max(0, len(trips) - orig_rows)
+    with metrics.stage("insert_rows"): w.expand_rows(curr_row + orig_rows - 1, extra) # 超出模板的明细行一次性补齐
+    r_tot, r_bk = 14 + extra, 15 + extra
+
+    with metrics.stage("fill"):
+        w.write('K2', fill_date.year)
+        w.write('M2', fill_date.month)
+        w.write('O2', fill_date.day)
+        w.write('B3', config['station_info']['name'])
+        w.write('G3', config['station_info']['name'])
+        w.write('B4', user['name'])
+        w.write('E4', trips[0].reason)
+        w.write('G4', "详见明细")
+        w.write('J4', date_desc)
+
+        for t in trips:
+            d = t.date
+            w.write(f'A{curr_row}', d.year)
+            w.write(f'B{curr_row}', d.month)
+            w.write(f'C{curr_row}', d.day)
+            w.write(f'D{curr_row}', t.start)
+            w.write(f'E{curr_row}', t.end)
+            if t.food:
+                w.write(f'H{curr_row}', 1)
+                w.write(f'I{curr_row}', t.food)
+            if t.misc:
+                w.write(f'M{curr_row}', t.misc)
+            curr_row += 1
+
+        w.write(f'G{r_tot}', num_to_cn_amount(total_money))
+        w.write(f'C{r_bk}', user['name'])
+        w.write(f'F{r_bk}', user['card'])
+        w.write(f'K{r_bk}', user['bank'])
+        w.write(f'N{r_bk}', user['phone'])
+    with metrics.stage("save"): wb.save(path)
+
+def audit_cells(config, user, trips, fill_date):
+    total_money = trips_total(trips)
+    return [('K4', fill_date.year), ('M4', fill_date.month), ('O4', fill_date.day),
+            ('E6', config['station_info']['name']),
+            ('J10', total_money), ('C11', num_to_cn_amount(total_money)),
+            ('C12', user['name']), ('F12', user['card']), ('K12', user['bank']), ('N12', user['phone'])]
+
+def no_car_cells(config, user, trips, fill_date):
+    t = trips[0]
+    d = t.date
+    fs, fe = (datetime.fromordinal(x) for x in t.span)
+    return [('F3', d.year), ('H3', d.month), ('J3', d.day),
+            ('B5', config['station_info']['name']), ('E5', user['name']), ('H5', t.end),
+            ('B7', t.reason),
+            ('B8', fs.month), ('D8', fs.day), ('F8', fe.month), ('H8', fe.day)]
+
+def fill_template(config, kind, cells, path):
+    # 固定版式表单：按配置选择 openpyxl 或 XML 直改，两者输出的单元格内容一致
+    template = config['template_paths'][kind]
+    metrics = current_metrics()
+    if config.get('render_backend', 'openpyxl') == 'xml':
+        with metrics.stage("template"): xt = TEMPLATE_CACHE.xml_template(template)
+        return xt.render(cells, path) # 内部分别计 fill/save
+    with metrics.stage("template"): wb = TEMPLATE_CACHE.workbook(template)
+    w = SheetWriter(wb.active)
+    with metrics.stage("fill"):
+        for coord, value in cells: w.write(coord, value)
+    with metrics.stage("save"): wb.save(path)
+
+def render_audit(config, user, trips, fill_date, path):
+    fill_template(config, 'audit', audit_cells(config, user, trips, fill_date), path)
+
+def render_no_car(config, user, trips, fill_date, path):
+    fill_template(config, 'no_car', no_car_cells(config, user, trips, fill_date), path)
+
+def render_no_car_book(config, user, trips, fill_date, path):
+    # 一次报销的全部未派车证明放进同一个工作簿，每条行程一张工作表 (需要复制工作表，固定走 openpyxl)。
+    # copy_worksheet 不带打印区域和打印标题，这里补上；模板里的图片 (如印章图) 无法随工作表复制，
+    # 模板带图片时请改用分文件输出。
+    metrics = current_metrics()
+    with metrics.stage("template"): wb = TEMPLATE_CACHE.workbook(config['template_paths']['no_car'])
+    template = wb.active
+    print_area = [r.split("!")[-1] for r in template.print_area.split(",")] if template.print_area else None
+    with metrics.stage("fill"):
+        for t in trips:
+            fs = datetime.fromordinal(t.span[0])
+            ws = wb.copy_worksheet(template)
+            ws.title = re.sub(r'[\\/*?:\[\]]', "", f"{fs.strftime('%m%d')}_{t.end}")[:31]
+            if print_area: ws.print_area = print_area
+            if template.print_title_rows: ws.print_title_rows = template.print_title_rows
+            if template.print_title_cols: ws.print_title_cols = template.print_title_cols
+            w = SheetWriter(ws)
+            for coord, value in no_car_cells(config, user, [t], fill_date): w.write(coord, value)
+    wb.remove(template)
+    wb.active = 0
+    with metrics.stage("save"): wb.save(path)
+
+RENDERERS = {"expense": render_expense, "audit": render_audit, "no_car": render_no_car, "no_car_book": render_no_car_book}
+TEMPLATE_KINDS = {"expense": "expense", "audit": "audit", "no_car": "no_car", "no_car_book": "no_car"}
+
+# --- 核心：增量生成缓存 ---
+# 每份文档的输入 (人员、相关行程、填报日期、所站信息、规则、渲染方式、模板内容哈希) 算一个指纹，
+# 连同生成后输出文件的 mtime/大小记在输出目录的 .build_cache/<姓名>.json 里 (按人分文件，批量并行时互不覆盖)。
+# 指纹相同且输出文件没被动过的文档下次直接跳过。
+BUILD_CACHE_DIR = ".build_cache"
+
+def document_fingerprint(config, user, fill_date, job):
+    trips = [[getattr(t, k) for k in Trip.FIELDS if k not in ("id", "user")] for t in job['trips']]
+    data = {"kind": job['kind'], "user": {k: user.get(k, "") for k in ("name", "phone", "bank", "card")}, "trips": trips,
+            "fill_date": fill_date, "station": config['station_info'], "rules": config['rules'],
+            "backend": config.get('render_backend', 'openpyxl'),
+            "template": TEMPLATE_CACHE.digest(config['template_paths'][TEMPLATE_KINDS[job['kind']]])}
+    return hashlib.sha1(json.dumps(data, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+class BuildCache:
+    def __init__(self, out_dir, name):
+        self.path = os.path.join(out_dir, BUILD_CACHE_DIR, clean_name(name) + ".json")
+        self.entries = {}
+        self.dirty = False
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f: self.entries = json.load(f)
+        except (OSError, ValueError): pass # 没有缓存或缓存损坏：全部重新生成
+
+    @staticmethod
+    def _stat(path):
+        st = os.stat(path)
+        return [st.st_mtime_ns, st.st_size]
+
+    def fresh(self, job):
+        e = self.entries.get(os.path.basename(job['path']))
+        if not e or e['fingerprint'] != job['fingerprint']: return False
+        try: return self._stat(job['path']) == e['stat']
+        except OSError: return False
+
+    def record(self, job):
+        self.entries[os.path.basename(job['path'])] = {"fingerprint": job['fingerprint'], "stat": self._stat(job['path'])}
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty: return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w', encoding='utf-8') as f: json.dump(self.entries, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+def render_document(config, user, fill_date, job):
+    # 先写临时文件再整体替换：中途取消或出错时，目标文件要么是旧的完整版本，要么是新的完整版本。
+    # 返回本文档的计量字典
+    _import_openpyxl()
+    tmp = job['path'] + ".tmp"
+    metrics = _ACTIVE.metrics = GenerationMetrics()
+    try:
+        with metrics.stage("total"):
+            RENDERERS[job['kind']](config, user, job['trips'], fill_date, tmp)
+            os.replace(tmp, job['path'])
+        metrics.count("documents")
+        metrics.count("bytes_saved", os.path.getsize(job['path']))
+    finally:
+        _ACTIVE.metrics = None
+        if os.path.exists(tmp): os.remove(tmp)
+    return metrics.to_dict()
+
+def iter_documents(config, user, trips, fill_date, out_dir="", cancel=None, workers=None, cache=True):
+    # 单人全部文档：先检查占用再逐份渲染，每完成一份 yield (序号, 总数, 任务)，任务的 'metrics' 为本文档计量；
+    # cancel (threading.Event) 置位后在两份文档之间停下，出错直接抛给调用方。
+    # 未派车证明互不依赖，数量多时分给进程池并行渲染 (workers=1 表示不开池，批量模式下每人已占一个进程)
+    # cache=True 时输入指纹和输出文件都没变的文档直接跳过 (任务带 'skipped')，只重写变了的
+    if not trips: raise ValueError("请先添加行程")
+    jobs = plan_documents(user, trips, fill_date, out_dir, config.get('nocar_output', 'files'))
+    build_cache = BuildCache(out_dir, user['name']) if cache else None
+    for job in jobs:
+        job['fingerprint'] = document_fingerprint(config, user, fill_date, job)
+        job['skipped'] = build_cache is not None and build_cache.fresh(job)
+    stale = [j for j in jobs if not j['skipped']]
+    locked = [j['path'] for j in stale if not check_file_lock(j['path'])]
+    if locked: raise PermissionError(f"文件正被 Excel 打开: {', '.join(locked)}")
+    parallel = [j for j in stale if j['kind'] == 'no_car']
+    if workers == 1 or len(parallel) < PARALLEL_MIN_JOBS: parallel = []
+    serial = [j for j in stale if j['kind'] != 'no_car' or not parallel]
+    done = 0
+    try:
+        for job in jobs:
+            if not job['skipped']: continue
+            job['metrics'] = {"stages": {}, "counters": {"documents_skipped": 1}}
+            done += 1
+            yield done, len(jobs), job
+        for job in serial:
+            if cancel is not None and cancel.is_set(): return
+            job['metrics'] = render_document(config, user, fill_date, job)
+            if build_cache is not None: build_cache.record(job)
+            done += 1
+            yield done, len(jobs), job
+        if not parallel: return
+        with ProcessPoolExecutor(max_workers=min(workers or os.cpu_count() or 1, len(parallel))) as pool:
+            futures = {pool.submit(render_document, config, user, fill_date, job): job for job in parallel}
+            try:
+                for f in as_completed(futures):
+                    job = futures[f]
+                    job['metrics'] = f.result()
+                    if build_cache is not None: build_cache.record(job)
+                    done += 1
+                    yield done, len(jobs), job
+                    if cancel is not None and cancel.is_set(): break
+            finally:
+                # 取消或出错：没开始的任务直接作废，正在写的让它写完 (原子替换，不会留下半个文件)
+                for f in futures: f.cancel()
+    finally:
+        # 取消/出错时已完成的文档也记下来，下次不用重做
+        if build_cache is not None: build_cache.save()
+
+def generate_documents(config, user, trips, fill_date, out_dir="", workers=None, metrics=None, cache=True):
+    files = []
+    for _, _, job in iter_documents(config, user, trips, fill_date, out_dir, workers=workers, cache=cache):
+        files.append(job['path'])
+        if metrics is not None: metrics.merge(job['metrics'])
+    return files
+
+def _batch_worker(config, user, trips, fill_date, out_dir, cache=True):
+    # 进程池入口：异常转成结果返回，一个人出错不影响整批
+    metrics = GenerationMetrics()
+    try: return user['name'], generate_documents(config, user, trips, fill_date, out_dir, workers=1, metrics=metrics, cache=cache), None, metrics.to_dict()
+    except Exception as e: return user['name'], [], str(e), metrics.to_dict()
+
+def load_manifest(path, config):
+    # 清单格式：JSON {"fill_date": ..., "users": [{"name", ..., "trips": [...]}]}
+    # 或 CSV (每行一条行程，name 列区分人员)。人员信息缺省时从 config['users'] 按姓名补全
+    known = {u['name']: u for u in config['users']}
+    pricing = PricingTable.from_config(config)
+    entries, fill_date = {}, None
+    if path.lower().endswith(".csv"):
+        with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+            for row in csv.DictReader(f):
+                name = row.pop('name').strip()
+                entries.setdefault(name, {"name": name, "trips": []})["trips"].append(row)
+    else:
+        with open(path, 'r', encoding='utf-8') as f: data = json.load(f)
+        if isinstance(data, dict):
+            fill_date = data.get('fill_date')
+            data = data.get('users', [])
+        for u in data: entries[u['name']] = dict(u)
+    result = []
+    for name, e in entries.items():
+        user = dict(known.get(name, {}))
+        user.update({k: v for k, v in e.items() if k != 'trips'})
+        for k in ("phone", "bank", "card"): user.setdefault(k, "")
+        result.append((user, trips_from_dicts(config, e.get('trips', []), pricing)))
+    return result, (parse_date(fill_date) if fill_date else None)
+
+def run_batch(config, entries, fill_date, out_dir="", workers=None, cache=True):
+    # 月底全所批量：每人一个任务，按 CPU 核数并行；workers=1 时在本进程内顺序执行 (便于剖析)
+    if out_dir: os.makedirs(out_dir, exist_ok=True)
+    if workers == 1: return [_batch_worker(config, user, trips, fill_date, out_dir, cache) for user, trips in entries]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_batch_worker, config, user, trips, fill_date, out_dir, cache) for user, trips in entries]
+        return [f.result() for f in futures]
+
+# --- 核心：行程台账 (SQLite) ---
+# 所有行程落盘，按 人员+日期 / 日期 / 终点 建索引；WAL 模式下生成任务读库时界面仍可读写。
+# 每个线程使用自己的连接 (sqlite3 连接不能跨线程共用)。
+class TripStore:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS trips (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user TEXT NOT NULL,
+            date TEXT NOT NULL,
+            start_place TEXT NOT NULL,
+            end_place TEXT NOT NULL,
+            food REAL NOT NULL DEFAULT 0,
+            misc REAL NOT NULL DEFAULT 0,
+            nocar INTEGER NOT NULL DEFAULT 0,
+            reason TEXT NOT NULL DEFAULT '',
+            full_start_date TEXT,
+            full_end_date TEXT,
+            is_return_trip INTEGER NOT NULL DEFAULT 0,
+            archived INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_trips_user_date ON trips(user, archived, date);
+        CREATE INDEX IF NOT EXISTS idx_trips_date ON trips(date);
+        CREATE INDEX IF NOT EXISTS idx_trips_end_date ON trips(end_place, date);
+        CREATE INDEX IF NOT EXISTS idx_trips_user_day ON trips(user, date);
+    """
+    COLUMNS = "id, user, date, start_place, end_place, food, misc, nocar, reason, full_start_date, full_end_date, is_return_trip"
+
+    def __init__(self, path=DB_FILE):
+        self.path = path
+        self._local = threading.local()
+        with self._conn() as conn: conn.executescript(self.SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _to_row(user, t):
+        day = lambda n: datetime.fromordinal(n).strftime("%Y-%m-%d") if n is not None else None
+        return (user, day(t.day), t.start, t.end, t.food, t.misc, int(bool(t.nocar)),
+                t.reason, day(t.full_start), day(t.full_end), int(bool(t.is_return_trip)))
+
+    @staticmethod
+    def _to_trip(row):
+        day = lambda s: datetime.fromisoformat(s).toordinal() if s else None
+        return Trip(day(row[2]), row[3], row[4], row[5], row[6], bool(row[7]), row[8], day(row[9]), day(row[10]), bool(row[11]), row[0], row[1])
+
+    def add(self, user, trips):
+        return self.add_many([(user, trips)])
+
+    def add_many(self, groups):
+        # [(姓名, 行程列表)] 在一个事务里写入
+        conn = self._conn()
+        with conn:
+            ids = []
+            for user, trips in groups:
+                for t in trips:
+                    cur = conn.execute("INSERT INTO trips (user, date, start_place, end_place, food, misc, nocar, reason, "
+                                       "full_start_date, full_end_date, is_return_trip) VALUES (?,?,?,?,?,?,?,?,?,?,?)", self._to_row(user, t))
+                    t.id, t.user = cur.lastrowid, user
+                    ids.append(cur.lastrowid)
+        return ids
+
+    def delete(self, ids):
+        with self._conn() as conn: conn.executemany("DELETE FROM trips WHERE id = ?", [(i,) for i in ids])
+
+    def update_prices(self, trips):
+        with self._conn() as conn: conn.executemany("UPDATE trips SET food = ?, misc = ? WHERE id = ?", [(t.food, t.misc, t.id) for t in trips])
+
+    def archive(self, user):
+        # “清空列表”不再丢数据：待报销行程转入历史
+        with self._conn() as conn: conn.execute("UPDATE trips SET archived = 1 WHERE user = ? AND archived = 0", (user,))
+
+    def query(self, user=None, start=None, end=None, destination=None, archived=None, batch=500):
+        # 逐批 fetchmany 的生成器：调用方按需取，不会一次把全年历史拉进内存
+        where, args = [], []
+        if user is not None: where.append("user = ?"); args.append(user)
+        if archived is not None: where.append("archived = ?"); args.append(int(archived))
+        if start is not None: where.append("date >= ?"); args.append(start.strftime("%Y-%m-%d"))
+        if end is not None: where.append("date <= ?"); args.append(end.strftime("%Y-%m-%d"))
+        if destination is not None: where.append("end_place = ?"); args.append(destination)
+        sql = f"SELECT {self.COLUMNS} FROM trips" + (" WHERE " + " AND ".join(where) if where else "") + " ORDER BY date, id"
+        cur = self._conn().execute(sql, args)
+        while True:
+            rows = cur.fetchmany(batch)
+            if not rows: break
+            for row in rows: yield self._to_trip(row)
+
+    def longest_span(self):
+        # 最长一次出差的天数差，区间查询据此确定回看多远
+        row = self._conn().execute("SELECT MAX(julianday(full_end_date) - julianday(full_start_date)) FROM trips WHERE is_return_trip = 0").fetchone()
+        return int(row[0] or 0)
+
+    def claims_near(self, user, fs, fe, longest):
+        # 起点落在 [fs-longest, fe] 的去程/当天行程 (ordinal 日期)，走 (user, date) 索引，供重复/重叠检查
+        day = lambda n: datetime.fromordinal(n).strftime("%Y-%m-%d")
+        sql = f"SELECT {self.COLUMNS} FROM trips WHERE user = ? AND date >= ? AND date <= ? AND is_return_trip = 0"
+        return [self._to_trip(row) for row in self._conn().execute(sql, (user, day(fs - longest), day(fe)))]
+
+    def users(self, start=None, end=None):
+        where, args = [], []
+        if start is not None: where.append("date >= ?"); args.append(start.strftime("%Y-%m-%d"))
+        if end is not None: where.append("date <= ?"); args.append(end.strftime("%Y-%m-%d"))
+        sql = "SELECT DISTINCT user FROM trips" + (" WHERE " + " AND ".join(where) if where else "") + " ORDER BY user"
+        return [r[0] for r in self._conn().execute(sql, args)]
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+def load_ledger_entries(store, config, start, end):
+    # 从台账按日期范围取出每个人的行程，格式与 load_manifest 一致，供批量生成使用
+    known = {u['name']: u for u in config['users']}
+    entries = []
+    for name in store.users(start, end):
+        user = dict(known.get(name, {"name": name}))
+        for k in ("phone", "bank", "card"): user.setdefault(k, "")
+        entries.append((user, list(store.query(user=name, start=start, end=end))))
+    return entries
+
+# --- 核心：批量导入 (派车/考勤系统导出的 Excel/CSV) ---
+# 逐行流式读取 (CSV 用 csv 模块，xlsx 用 openpyxl 只读模式)，表头按别名对应到行程字段，
+# 每行拆成报销行并按计价表定价，攒够一批写一次台账；有问题的行记下行号和原因，不中断导入。
+IMPORT_COLUMNS = {
+    "name": ("name", "姓名", "报销人", "人员", "乘车人"),
+    "start_date": ("start_date", "date", "出发日期", "开始日期", "日期", "用车日期"),
+    "end_date": ("end_date", "返回日期", "结束日期", "回程日期"),
+    "start": ("start", "起点", "出发地"),
+    "end": ("end", "终点", "目的地", "到达地"),
+    "nocar": ("nocar", "未派车", "需未派车证明"),
+    "reason": ("reason", "事由", "出差事由", "用途"),
+}
+IMPORT_REQUIRED = ("name", "start_date", "end")
+
+def map_import_header(header):
+    aliases = {a.lower(): field for field, names in IMPORT_COLUMNS.items() for a in names}
+    columns = {}
+    for i, h in enumerate(header):
+        field = aliases.get(str(h).strip().lower()) if h is not None else None
+        if field and field not in columns: columns[field] = i
+    missing = [f for f in IMPORT_REQUIRED if f not in columns]
+    if missing: raise ValueError(f"表头缺少列: {', '.join(IMPORT_COLUMNS[f][1] for f in missing)}")
+    return columns
+
+def iter_import_rows(path):
+    # 逐行产出 (行号, 原始值元组)，第一行是表头
+    if path.lower().endswith(".csv"):
+        with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+            for i, row in enumerate(csv.reader(f), 1): yield i, row
+        return
+    _import_openpyxl()
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        for i, row in enumerate(wb.active.iter_rows(values_only=True), 1): yield i, row
+    finally: wb.close()
+
+def parse_import_date(value):
+    if isinstance(value, datetime): return value
+    if hasattr(value, 'year'): return datetime(value.year, value.month, value.day)
+    text = str(value).strip()
+    if not text: raise ValueError("日期为空")
+    text = text.split()[0].replace("/", "-").replace(".", "-")
+    return datetime.strptime(text, "%Y-%m-%d")
+
+def import_trips(store, config, path, batch=500, dry_run=False):
+    # 返回 (读入行数, 生成报销行数, [(行号, 原因)])；dry_run 只检查不写库。
+    # 与台账或本文件前面的行重复/重叠的行也算问题行，不导入 (同一份导出导两次不会重复入账)。
+    # 查重不把台账读进内存：每行按 人员+日期 范围查一次库；本文件已接受的行每批写库后也就能查到，
+    # 内存里只留还没写库的这一批。dry_run 时这些行写进一个临时库，用完删除。
+    pricing = PricingTable.from_config(config)
+    known = {u['name'] for u in config['users']}
+    rows = added = 0
+    errors, pending = [], {}
+    target, scratch_path = store, None
+    if dry_run:
+        import tempfile
+        fd, scratch_path = tempfile.mkstemp(suffix=".db", prefix="travel_tool_import_")
+        os.close(fd)
+        target = TripStore(scratch_path)
+    stores = [store] if target is store else [store, target]
+    longest = store.longest_span()
+    pending_index = TripIntervalIndex()
+
+    def flush():
+        nonlocal added, pending_index
+        target.add_many(pending.items())
+        added += sum(len(legs) for legs in pending.values())
+        pending.clear()
+        pending_index = TripIntervalIndex()
+
+    def conflicts(name, claim):
+        found = pending_index.conflicts(name, claim)
+        for s in stores:
+            if found: break
+            found = TripIntervalIndex(s.claims_near(name, *claim.span, longest)).conflicts(name, claim)
+        return found
+
+    try:
+        it = iter_import_rows(path)
+        header = next(it, (0, None))[1]
+        if not header: raise ValueError("文件是空的")
+        columns = map_import_header(header)
+        cell = lambda row, f: row[columns[f]] if f in columns and columns[f] < len(row) else None
+        buffered = 0
+        for line, row in it:
+            if not any(v not in (None, "") for v in row): continue # 空行
+            rows += 1
+            try:
+                name = str(cell(row, 'name') or "").strip()
+                end_place = str(cell(row, 'end') or "").strip()
+                if not name: raise ValueError("缺少姓名")
+                if known and name not in known: raise ValueError(f"{name} 不在人员名单中")
+                if not end_place: raise ValueError("缺少终点")
+                try:
+                    start_date = parse_import_date(cell(row, 'start_date'))
+                    end_raw = cell(row, 'end_date')
+                    end_date = parse_import_date(end_raw) if str(end_raw if end_raw is not None else "").strip() else start_date
+                except (ValueError, TypeError): raise ValueError("日期无效")
+                if end_date < start_date: raise ValueError("返回日期早于出发日期")
+                legs = make_trip_legs(config, str(cell(row, 'start') or "本所").strip(), end_place, start_date, end_date,
+                                      parse_bool(cell(row, 'nocar') or False), str(cell(row, 'reason') or "差旅").strip(), pricing)
+                found = conflicts(name, legs[0])
+                if found: raise ValueError(f"与 {describe_trip(found[0][1])} {CONFLICT_NAMES[found[0][0]]}")
+            except ValueError as e:
+                errors.append((line, str(e)))
+                continue
+            for leg in legs: pending_index.add(name, leg)
+            longest = max(longest, legs[0].span[1] - legs[0].span[0])
+            pending.setdefault(name, []).extend(legs)
+            buffered += len(legs)
+            if buffered >= batch:
+                flush()
+                buffered = 0
+        flush()
+    finally:
+        if scratch_path:
+            target.close()
+            os.remove(scratch_path)
+    return rows, added, errors
+
+# --- 核心：月度汇总报表 ---
+# 行程逐条流过只做累加 (人数、天数都有上限)，写出用 openpyxl 只写模式逐行落盘，全所一年的数据内存也不涨。
+DEST_CLASS_NAMES = {"local": "辖区线路", "county": "县内", "city": "县外"}
+
+def rollup_trips(trips, station):
+    people, classes, days = {}, {c: [0, 0] for c in DEST_CLASSES}, {}
+    for t in trips:
+        money = t.food + t.misc
+        p = people.setdefault(t.user, {"trips": 0, "nocar": 0, "food": 0, "misc": 0})
+        p['trips'] += 1
+        p['nocar'] += bool(t.nocar)
+        p['food'] += t.food
+        p['misc'] += t.misc
+        c = classes[classify_destination(trip_destination(t), station)]
+        c[0] += 1
+        c[1] += money
+        d = days.setdefault(t.day, [0, 0])
+        d[0] += 1
+        d[1] += money
+    return {"people": people, "classes": classes, "days": days}
+
+def write_rollup_report(summary, title, path):
+    _import_openpyxl()
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font
+    wb = openpyxl.Workbook(write_only=True)
+    bold = Font(bold=True)
+    def sheet(name, header, widths):
+        ws = wb.create_sheet(name)
+        for i, w in enumerate(widths): ws.column_dimensions[get_column_letter(i + 1)].width = w
+        ws.append([title])
+        cells = []
+        for h in header:
+            c = WriteOnlyCell(ws, value=h)
+            c.font = bold
+            cells.append(c)
+        ws.append(cells)
+        return ws
+
+    ws = sheet("按人员", ["姓名", "行程数", "未派车", "伙食补助", "杂费", "合计", "合计 (大写)"], [12, 8, 8, 10, 10, 10, 30])
+    total = {"trips": 0, "nocar": 0, "food": 0, "misc": 0}
+    for name, p in sorted(summary['people'].items()):
+        ws.append([name, p['trips'], p['nocar'], p['food'], p['misc'], p['food'] + p['misc'], num_to_cn_amount(p['food'] + p['misc'])])
+        for k in total: total[k] += p[k]
+    money = total['food'] + total['misc']
+    ws.append(["合计", total['trips'], total['nocar'], total['food'], total['misc'], money, num_to_cn_amount(money)])
+
+    ws = sheet("按类别", ["目的地", "行程数", "金额"], [12, 8, 10])
+    for cls in DEST_CLASSES: ws.append([DEST_CLASS_NAMES[cls], *summary['classes'][cls]])
+
+    ws = sheet("按日期", ["日期", "行程数", "金额"], [12, 8, 10])
+    for day in sorted(summary['days']): ws.append([datetime.fromordinal(day).strftime("%Y-%m-%d"), *summary['days'][day]])
+
+    tmp_path = path + ".tmp"
+    try:
+        wb.save(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        raise
+    return money
+
+def month_range(month):
+    start = datetime.strptime(month, "%Y-%m")
+    return start, (start + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+
+def build_rollup_report(store, config, start, end, path):
+    summary = rollup_trips(store.query(start=start, end=end), config['station_info'])
+    span = f"{start.year} 年 {start.month} 月" if (start.day, end) == (1, month_range(start.strftime("%Y-%m"))[1]) \
+        else f"{start.strftime('%Y-%m-%d')} 至 {end.strftime('%Y-%m-%d')}"
+    write_rollup_report(summary, f"{config['station_info']['name']} {span} 差旅费汇总", path)
+    return summary
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="travel_tool", description="供电所差旅费工具 (命令行批量模式)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_batch = sub.add_parser("batch", help="按清单批量生成全所人员的报销文件")
+    p_batch.add_argument("manifest", nargs="?", help="人员+行程清单 (.json / .csv)；不给则从台账读取")
+    p_batch.add_argument("--db", default=DB_FILE, help="行程台账 (SQLite)")
+    p_batch.add_argument("--from", dest="date_from", help="台账起始日期 YYYY-MM-DD")
+    p_batch.add_argument("--to", dest="date_to", help="台账截止日期 YYYY-MM-DD")
+    p_batch.add_argument("--config", default=CONFIG_FILE)
+    p_batch.add_argument("--fill-date", help="填报日期 YYYY-MM-DD，缺省取清单内或今天")
+    p_batch.add_argument("--out", default="", help="输出目录")
+    p_batch.add_argument("--workers", type=int, default=None, help="并行进程数，缺省为 CPU 核数")
+    p_batch.add_argument("--backend", choices=("openpyxl", "xml"), help="审核单/未派车证明的渲染方式，缺省取配置")
+    p_batch.add_argument("--nocar-output", choices=("files", "workbook"), help="未派车证明分文件或合并为一个工作簿，缺省取配置")
+    p_batch.add_argument("--report", help="把本次运行的计时/计数报告写到这个 JSON 文件")
+    p_batch.add_argument("--profile", action="store_true", help="开启 cProfile + tracemalloc (强制单进程)")
+    p_batch.add_argument("--force", action="store_true", help="忽略增量缓存，全部重新生成")
+    p_reprice = sub.add_parser("reprice", help="按计价规则重算台账金额 (缺省只试算，不写库)")
+    p_reprice.add_argument("--db", default=DB_FILE, help="行程台账 (SQLite)")
+    p_reprice.add_argument("--config", default=CONFIG_FILE)
+    p_reprice.add_argument("--from", dest="date_from", help="起始日期 YYYY-MM-DD")
+    p_reprice.add_argument("--to", dest="date_to", help="截止日期 YYYY-MM-DD")
+    p_reprice.add_argument("--user", help="只算这个人")
+    p_reprice.add_argument("--set", dest="overrides", action="append", default=[], metavar="类别.项目=金额",
+                           help="试算用的临时规则，如 county.misc_one_way=20，可多次给出")
+    p_reprice.add_argument("--apply", action="store_true", help="把重算结果写回台账")
+    p_report = sub.add_parser("report", help="生成全所差旅费汇总表 (按人员/目的地/日期)")
+    p_report.add_argument("--db", default=DB_FILE, help="行程台账 (SQLite)")
+    p_report.add_argument("--config", default=CONFIG_FILE)
+    p_report.add_argument("--month", help="统计月份 YYYY-MM，缺省为上个月")
+    p_report.add_argument("--from", dest="date_from", help="起始日期 YYYY-MM-DD (与 --to 一起代替 --month)")
+    p_report.add_argument("--to", dest="date_to", help="截止日期 YYYY-MM-DD")
+    p_report.add_argument("--out", help="输出文件，缺省为 汇总_<月份>.xlsx")
+    p_import = sub.add_parser("import", help="从派车/考勤系统导出的 Excel/CSV 批量导入行程到台账")
+    p_import.add_argument("file", help="导出文件 (.xlsx / .csv)，第一行为表头")
+    p_import.add_argument("--db", default=DB_FILE, help="行程台账 (SQLite)")
+    p_import.add_argument("--config", default=CONFIG_FILE)
+    p_import.add_argument("--errors", help="把有问题的行 (行号, 原因) 写到这个 CSV")
+    p_import.add_argument("--dry-run", action="store_true", help="只检查不写库")
+    p_validate = sub.add_parser("validate", help="检查台账里重复、时间重叠的行程")
+    p_validate.add_argument("--db", default=DB_FILE, help="行程台账 (SQLite)")
+    p_validate.add_argument("--from", dest="date_from", help="起始日期 YYYY-MM-DD")
+    p_validate.add_argument("--to", dest="date_to", help="截止日期 YYYY-MM-DD")
+    p_validate.add_argument("--user", help="只查这个人")
+    p_serve = sub.add_parser("serve", help="本机生成服务：多个所共用一台机器、一份模板缓存")
+    p_serve.add_argument("stations", help="各所配置目录，每个 <所代号>.json 是一个所的 config.json (模板路径相对该文件)")
+    p_serve.add_argument("--host", default="127.0.0.1")
+    p_serve.add_argument("--port", type=int, default=8765)
+    p_serve.add_argument("--workers", type=int, default=None, help="渲染进程数，缺省为 CPU 核数")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    if args.command == "reprice": return reprice_command(parser, args)
+    if args.command == "report": return report_command(parser, args)
+    if args.command == "import": return import_command(parser, args)
+    if args.command == "validate": return validate_command(parser, args)
+    if args.command == "serve": return serve_command(parser, args)
+
+    config = load_config(args.config)
+    if args.backend: config['render_backend'] = args.backend
+    if args.nocar_output: config['nocar_output'] = args.nocar_output
+    if args.manifest: entries, manifest_date = load_manifest(args.manifest, config)
+    else:
+        if not os.path.exists(args.db): parser.error(f"找不到台账 {args.db}")
+        store = TripStore(args.db)
+        entries, manifest_date = load_ledger_entries(store, config, parse_date(args.date_from) if args.date_from else None,
+                                                     parse_date(args.date_to) if args.date_to else None), None
+        store.close()
+    fill_date = parse_date(args.fill_date) if args.fill_date else (manifest_date or datetime.now())
+    profile = args.profile or bool(os.environ.get("TRAVEL_TOOL_PROFILE"))
+    failed, total, people = 0, GenerationMetrics(), []
+    t0 = time.perf_counter()
+    with profiling(profile, tag="batch") as prof:
+        results = run_batch(config, entries, fill_date, args.out, 1 if profile else args.workers, cache=not args.force)
+    for name, files, error, metrics in results:
+        total.merge(metrics)
+        people.append({"user": name, "files": len(files), "error": error, **metrics})
+        if error:
+            failed += 1
+            print(f"[失败] {name}: {error}")
+        else:
+            skipped = metrics['counters'].get('documents_skipped', 0)
+            print(f"[完成] {name}: {len(files)} 份" + (f" (其中 {skipped} 份未变化，已跳过)" if skipped else ""))
+    print(f"共 {len(entries)} 人，失败 {failed} 人")
+    report = {"mode": "batch", "run_at": datetime.now().isoformat(timespec='seconds'), "wall_seconds": round(time.perf_counter() - t0, 3),
+              "backend": config.get('render_backend', 'openpyxl'), "users": len(entries), "failed": failed, **total.to_dict(), "profile": prof}
+    write_run_report(report)
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f: json.dump(dict(report, per_user=people), f, indent=2, ensure_ascii=False)
+    return 1 if failed else 0
+
+def reprice_command(parser, args):
+    config = load_config(args.config)
+    rules = deepcopy(config['rules'])
+    for item in args.overrides:
+        try:
+            key, value = item.split("=", 1)
+            cls, field = key.split(".", 1)
+            if field not in rules[cls]: raise KeyError(field)
+            rules[cls][field] = float(value)
+        except (ValueError, KeyError): parser.error(f"无法识别的规则 {item}")
+    if not os.path.exists(args.db): parser.error(f"找不到台账 {args.db}")
+    store = TripStore(args.db)
+    trips = list(store.query(user=args.user, start=parse_date(args.date_from) if args.date_from else None,
+                             end=parse_date(args.date_to) if args.date_to else None))
+    t0 = time.perf_counter()
+    prices = PricingTable(rules, config['station_info']).price_many(trips)
+    elapsed = time.perf_counter() - t0
+    per_user, changed = {}, []
+    for t, (food, misc) in zip(trips, prices):
+        totals = per_user.setdefault(t.user, [0, 0])
+        totals[0] += t.food + t.misc
+        totals[1] += food + misc
+        if (food, misc) != (t.food, t.misc):
+            t.food, t.misc = food, misc
+            changed.append(t)
+    for name, (before, after) in sorted(per_user.items()):
+        print(f"{name}: {before:.2f} -> {after:.2f} ({after - before:+.2f})")
+    before, after = sum(v[0] for v in per_user.values()), sum(v[1] for v in per_user.values())
+    print(f"共 {len(trips)} 条行程 ({elapsed * 1000:.1f} ms)，{len(changed)} 条金额变化，合计 {before:.2f} -> {after:.2f} ({after - before:+.2f})")
+    if args.apply and changed:
+        store.update_prices(changed)
+        print("已写回台账")
+    store.close()
+    return 0
+
+def report_command(parser, args):
+    config = load_config(args.config)
+    if args.date_from or args.date_to:
+        if not (args.date_from and args.date_to): parser.error("--from 与 --to 需要同时给出")
+        start, end = parse_date(args.date_from), parse_date(args.date_to)
+        label = f"{start.strftime('%Y%m%d')}-{end.strftime('%Y%m%d')}"
+    else:
+        try: start, end = month_range(args.month or (datetime.now().replace(day=1) - timedelta(days=1)).strftime("%Y-%m"))
+        except ValueError: parser.error(f"月份格式应为 YYYY-MM: {args.month}")
+        label = start.strftime("%Y%m")
+    if not os.path.exists(args.db): parser.error(f"找不到台账 {args.db}")
+    store = TripStore(args.db)
+    path = args.out or f"汇总_{label}.xlsx"
+    summary = build_rollup_report(store, config, start, end, path)
+    store.close()
+    total = sum(p['food'] + p['misc'] for p in summary['people'].values())
+    print(f"{len(summary['people'])} 人，{sum(c[0] for c in summary['classes'].values())} 条行程，合计 {total:.2f} 元 -> {path}")
+    return 0
+
+def import_command(parser, args):
+    config = load_config(args.config)
+    store = TripStore(args.db)
+    t0 = time.perf_counter()
+    try: rows, added, errors = import_trips(store, config, args.file, dry_run=args.dry_run)
+    except (OSError, ValueError) as e: parser.error(str(e))
+    finally: store.close()
+    for line, reason in errors[:20]: print(f"[第 {line} 行] {reason}")
+    if len(errors) > 20: print(f"... 另有 {len(errors) - 20} 行有问题")
+    if args.errors:
+        with open(args.errors, 'w', encoding='utf-8-sig', newline='') as f:
+            w = csv.writer(f)
+            w.writerow(["行号", "原因"])
+            w.writerows(errors)
+    print(f"读入 {rows} 行，{'可导入' if args.dry_run else '导入'} {added} 条报销行程，{len(errors)} 行有问题 ({time.perf_counter() - t0:.2f} s)")
+    return 1 if errors else 0
+
+def validate_command(parser, args):
+    if not os.path.exists(args.db): parser.error(f"找不到台账 {args.db}")
+    store = TripStore(args.db)
+    t0 = time.perf_counter()
+    found = find_trip_conflicts(store.query(user=args.user, start=parse_date(args.date_from) if args.date_from else None,
+                                            end=parse_date(args.date_to) if args.date_to else None))
+    store.close()
+    for kind, user, a, b in found: print(f"[{CONFLICT_NAMES[kind]}] {user}: {describe_trip(a)} (#{a.id}) / {describe_trip(b)} (#{b.id})")
+    print(f"发现 {len(found)} 处问题 ({time.perf_counter() - t0:.2f} s)")
+    return 1 if found else 0
+
+# --- 服务模式：多所共用的本机生成服务 ---
+# stations 目录里每个 <所代号>.json 是一个所的配置，按需加载并常驻内存 (文件改了自动重读)。
+#   GET  /stations             所代号列表
+#   POST /generate/<所代号>    {"user": 姓名或人员信息, "trips": [...], "fill_date": "YYYY-MM-DD", "nocar_output": 可选}
+#                              行程没给 food/misc 时按该所规则计价；返回全部文档的 zip，chunked 编码边打包边发送
+# 渲染交给常驻进程池：工作进程长期存活，各自的 TEMPLATE_CACHE 跨请求保留，模板在每个进程里只解析一次。
+SERVICE_MAX_BODY = 10 * 1024 * 1024
+RE_STATION = re.compile(r'[^\\/:*?"<>|.]+')
+
+class StationRegistry:
+    def __init__(self, folder):
+        self.folder = folder
+        self._stations = {}
+        self._lock = threading.Lock()
+
+    def _load(self, path):
+        with open(path, 'r', encoding='utf-8') as f: config = json.load(f)
+        base = os.path.dirname(os.path.abspath(path))
+        config['template_paths'] = {k: os.path.join(base, v) for k, v in config['template_paths'].items()}
+        return config
+
+    def get(self, station):
+        if not RE_STATION.fullmatch(station): return None
+        path = os.path.join(self.folder, station + ".json")
+        try: mtime = os.stat(path).st_mtime_ns
+        except OSError: return None
+        with self._lock:
+            e = self._stations.get(station)
+            if e is None or e[0] != mtime: e = self._stations[station] = (mtime, self._load(path))
+            return e[1]
+
+    def names(self):
+        return sorted(os.path.splitext(f)[0] for f in os.listdir(self.folder) if f.endswith(".json"))
+
+def parse_service_request(config, req):
+    u = req.get('user')
+    if isinstance(u, str): u = {"name": u}
+    if not isinstance(u, dict) or not u.get('name'): raise ValueError("缺少报销人")
+    user = dict({x['name']: x for x in config['users']}.get(u['name'], {}))
+    user.update(u)
+    for k in ("phone", "bank", "card"): user.setdefault(k, "")
+    raws = req.get('trips') or []
+    trips = trips_from_dicts(config, raws)
+    if not trips: raise ValueError("请先添加行程")
+    # 姓名、终点会进输出文件名：服务不接受带路径成分的值
+    for value in [user['name']] + [t.end for t in trips]:
+        if RE_UNSAFE_NAME.search(str(value)) or ".." in str(value): raise ValueError(f"名称含非法字符: {value}")
+    if any(t.day is None for t in trips): raise ValueError("行程缺少日期")
+    if req.get('nocar_output') in ("files", "workbook"): config = dict(config, nocar_output=req['nocar_output'])
+    fill_date = parse_date(req['fill_date']) if req.get('fill_date') else datetime.now()
+    return config, user, trips, fill_date
+
+def _service_render(config, user, trips, fill_date, out_dir):
+    metrics = GenerationMetrics()
+    files = generate_documents(config, user, trips, fill_date, out_dir, workers=1, metrics=metrics, cache=False)
+    return files, metrics.to_dict()
+
+class _ChunkedWriter:
+    # zipfile 写不可 seek 的流时用数据描述符，不需要 tell/seek；每次 write 作为一个 HTTP chunk 发出
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, data):
+        if data: self.wfile.write(b"%X\r\n%s\r\n" % (len(data), data))
+        return len(data)
+
+    def flush(self):
+        self.wfile.flush()
+
+    def close(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+def make_service_handler(registry, pool):
+    from http.server import BaseHTTPRequestHandler
+    from urllib.parse import quote, unquote
+    import shutil
+    import tempfile
+
+    class ServiceHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, fmt, *args):
+            log.info("%s %s", self.address_string(), fmt % args)
+
+        def send_json(self, code, data):
+            body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/stations": return self.send_json(200, {"stations": registry.names()})
+            self.send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            parts = self.path.strip("/").split("/")
+            if len(parts) != 2 or parts[0] != "generate": return self.send_json(404, {"error": "not found"})
+            station = unquote(parts[1])
+            try: length = int(self.headers.get("Content-Length") or 0)
+            except ValueError: length = -1
+            if length < 0:
+                self.close_connection = True
+                return self.send_json(400, {"error": "Content-Length 无效"})
+            if length > SERVICE_MAX_BODY:
+                self.close_connection = True
+                return self.send_json(413, {"error": "请求太大"})
+            body = self.rfile.read(length)
+            try: config = registry.get(station)
+            except (OSError, ValueError, KeyError) as e: return self.send_json(500, {"error": f"{station} 的配置无法读取: {e}"})
+            if config is None: return self.send_json(404, {"error": f"没有这个所: {station}"})
+            try: config, user, trips, fill_date = parse_service_request(config, json.loads(body))
+            except (ValueError, TypeError, AttributeError) as e: return self.send_json(400, {"error": str(e)})
+
+            t0 = time.perf_counter()
+            out_dir = tempfile.mkdtemp(prefix="travel_tool_")
+            try:
+                try: files, metrics = pool.submit(_service_render, config, user, trips, fill_date, out_dir).result()
+                except Exception:
+                    log.exception("生成失败: %s %s", station, user['name'])
+                    return self.send_json(500, {"error": "生成失败，详见服务日志"})
+                name = f"{station}_{user['name']}_{fill_date.strftime('%m%d')}.zip"
+                self.send_response(200)
+                self.send_header("Content-Type", "application/zip")
+                self.send_header("Content-Disposition", f"attachment; filename=\"documents.zip\"; filename*=UTF-8''{quote(name)}")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                out = _ChunkedWriter(self.wfile)
+                with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as zf:
+                    for f in files: zf.write(f, os.path.basename(f))
+                out.close()
+                write_run_report({"mode": "serve", "run_at": datetime.now().isoformat(timespec='seconds'), "station": station,
+                                  "user": user['name'], "trips": len(trips), "wall_seconds": round(time.perf_counter() - t0, 3), **metrics})
+            except ConnectionError:
+                log.warning("客户端已断开: %s %s", station, user['name'])
+                self.close_connection = True
+            finally: shutil.rmtree(out_dir, ignore_errors=True)
+
+    return ServiceHandler
+
+def serve_command(parser, args):
+    from http.server import ThreadingHTTPServer
+    if not os.path.isdir(args.stations): parser.error(f"找不到配置目录 {args.stations}")
+    registry = StationRegistry(args.stations)
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        server = ThreadingHTTPServer((args.host, args.port), make_service_handler(registry, pool))
+        print(f"生成服务已启动: http://{args.host}:{server.server_address[1]}  ({len(registry.names())} 个所)")
+        try: server.serve_forever()
+        except KeyboardInterrupt: pass
+        finally: server.server_close()
+    return 0
+
+# --- 界面：行程列表 (增量更新 + 大列表虚拟化) ---
+# 行数不多时每条行程对应一个 Treeview 条目，增删只动变化的那几行；
+# 超过 VIRTUAL_THRESHOLD 行后只保留可见窗口那么多条目，滚动时改写条目内容。
+class TripListView:
+    VIRTUAL_THRESHOLD = 500
+
+    def __init__(self, parent, columns, height=15, on_change=None):
+        self.height = height
+        self.on_change = on_change
+        self.trips = []
+        self.total = 0
+        self.virtual = False
+        self.offset = 0
+        self.selected = None # 虚拟模式下选中行的绝对下标
+        frame = ttk.Frame(parent)
+        frame.pack(fill='both', expand=True)
+        self.tree = ttk.Treeview(frame, columns=columns, show='headings', height=height, selectmode='browse')
+        self.scroll = ttk.Scrollbar(frame, orient='vertical')
+        self.scroll.pack(side='right', fill='y')
+        self.tree.pack(side='left', fill='both', expand=True)
+        self.tree.bind("<MouseWheel>", lambda e: self._wheel(-1 if e.delta > 0 else 1))
+        self.tree.bind("<Button-4>", lambda e: self._wheel(-1))
+        self.tree.bind("<Button-5>", lambda e: self._wheel(1))
+        self.tree.bind("<<TreeviewSelect>>", self._on_select)
+        self._set_virtual(False)
+
+    @staticmethod
+    def row_values(t):
+        return (t.date.strftime("%m-%d"), f"{t.start}->{t.end}", fmt_amount(t.food + t.misc), "是" if t.nocar else "-")
+
+    def _changed(self):
+        if self.on_change: self.on_change(self.total)
+
+    def _set_virtual(self, virtual):
+        self.virtual = virtual
+        self.tree.delete(*self.tree.get_children())
+        if virtual:
+            self.tree.config(yscrollcommand='')
+            self.scroll.config(command=self._on_scroll)
+            for i in range(self.height): self.tree.insert('', 'end', iid=f"v{i}", values=("", "", "", ""))
+            self._render_window()
+        else:
+            self.tree.config(yscrollcommand=self.scroll.set)
+            self.scroll.config(command=self.tree.yview)
+            for t in self.trips: self.tree.insert('', 'end', values=self.row_values(t))
+
+    def set_trips(self, trips):
+        # 整体换数据 (切换报销人/排序后)，只在这里全量重建
+        self.trips = trips
+        self.total = trips_total(trips)
+        self.offset, self.selected = 0, None
+        self._set_virtual(len(trips) > self.VIRTUAL_THRESHOLD)
+        self._changed()
+
+    def append(self, new_trips):
+        self.trips.extend(new_trips)
+        self.total += trips_total(new_trips)
+        if self.virtual or len(self.trips) > self.VIRTUAL_THRESHOLD:
+            self.offset = max(0, len(self.trips) - self.height) # 跳到末尾显示新加的行
+            if self.virtual: self._render_window()
+            else: self._set_virtual(True)
+        else:
+            for t in new_trips: self.tree.see(self.tree.insert('', 'end', values=self.row_values(t)))
+        self._changed()
+
+    def selected_index(self):
+        if self.virtual: return self.selected
+        sel = self.tree.selection()
+        return self.tree.index(sel[0]) if sel else None
+
+    def remove_selected(self):
+        idx = self.selected_index()
+        if idx is None: return None
+        t = self.trips.pop(idx)
+        self.total -= t.amount
+        if self.virtual:
+            self.selected = None
+            self._render_window()
+        else: self.tree.delete(self.tree.selection()[0])
+        self._changed()
+        return t
+
+    def _on_select(self, event):
+        if not self.virtual: return
+        sel = self.tree.selection()
+        if sel and self.tree.item(sel[0], 'values')[0] != "": self.selected = self.offset + int(sel[0][1:])
+
+    def _wheel(self, step):
+        if not self.virtual: return
+        self._scroll_to(self.offset + step * 3)
+        return "break"
+
+    def _on_scroll(self, action, value, unit=None):
+        if action == 'moveto': self._scroll_to(int(float(value) * len(self.trips)))
+        else: self._scroll_to(self.offset + int(value) * (self.height if unit == 'pages' else 1))
+
+    def _scroll_to(self, offset):
+        offset = max(0, min(offset, len(self.trips) - self.height))
+        if offset != self.offset:
+            self.offset = offset
+            self._render_window()
+
+    def _render_window(self):
+        n = len(self.trips)
+        for i in range(self.height):
+            idx = self.offset + i
+            self.tree.item(f"v{i}", values=self.row_values(self.trips[idx]) if idx < n else ("", "", "", ""))
+        self.tree.selection_set([f"v{self.selected - self.offset}"] if self.selected is not None and 0 <= self.selected - self.offset < self.height else [])
+        self.scroll.set(self.offset / n if n else 0, min(1, (self.offset + self.height) / n) if n else 1)
+
 class TravelApp:
     def __init__(self, root):
         self.root = root
         self.root.title("供电所差旅费工具 V2.6 (防崩+权限检测版)")
         self.root.geometry("960x780")
         self.config = self.load_config()
-        self.trip_list = self.load_test_data() # 内置测试数据
+        self.store = TripStore(DB_FILE)
+        self.pricing = PricingTable.from_config(self.config)
+        self.trip_list = []
         self.setup_ui()
+        self.root.after_idle(self.report_startup_time)
 
-    def load_test_data(self):
-        trips = []
-        # 预置7条测试数据，涵盖各种情况
-        trips.append({"date": datetime(2024,5,6), "start": "龙潭", "end": "辖区", "food":40, "misc":0, "nocar":True, "reason":"线路巡视", "full_start_date":datetime(2024,5,6), "full_end_date":datetime(2024,5,6)})
-        trips.append({"date": datetime(2024,5,8), "start": "龙潭", "end": "桃源县", "food":0, "misc":30, "nocar":False, "reason":"递交资料", "full_start_date":datetime(2024,5,8), "full_end_date":datetime(2024,5,8)})
-        trips.append({"date": datetime(2024,5,10), "start": "龙潭", "end": "常德市", "food":0, "misc":25, "nocar":True, "reason":"技能培训", "full_start_date":datetime(2024,5,10), "full_end_date":datetime(2024,5,12)})
-        trips.append({"date": datetime(2024,5,12), "start": "常德市", "end": "龙潭", "food":0, "misc":25, "nocar":False, "reason":"技能培训", "full_start_date":datetime(2024,5,10), "full_end_date":datetime(2024,5,12)})
-        trips.append({"date": datetime(2024,5,15), "start": "龙潭", "end": "桃源县", "food":0, "misc":15, "nocar":False, "reason":"季度会议", "full_start_date":datetime(2024,5,15), "full_end_date":datetime(2024,5,16)})
-        trips.append({"date": datetime(2024,5,16), "start": "桃源县", "end": "龙潭", "food":0, "misc":15, "nocar":False, "reason":"季度会议", "full_start_date":datetime(2024,5,15), "full_end_date":datetime(2024,5,16)})
-        trips.append({"date": datetime(2024,5,20), "start": "龙潭", "end": "辖区", "food":40, "misc":0, "nocar":False, "reason":"临时抢修", "full_start_date":datetime(2024,5,20), "full_end_date":datetime(2024,5,20)})
-        return trips
+    def report_startup_time(self):
+        # 主循环第一次空闲 = 行程录入页已可操作
+        log.info("启动耗时 %.0f ms (其中模块导入 %.0f ms)", (time.perf_counter() - _T_START) * 1000, (_T_IMPORTED - _T_START) * 1000)
 
     def load_config(self):
-        if not os.path.exists(CONFIG_FILE): return DEFAULT_CONFIG
-        try:
-            with open(CONFIG_FILE, 'r', encoding='utf-8') as f: return json.load(f)
-        except: return DEFAULT_CONFIG
+        return load_config(CONFIG_FILE)
 
     def save_config(self):
         with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
             json.dump(self.config, f, indent=4, ensure_ascii=False)
 
-    # --- 核心：安全写入函数 (防崩版) ---
     def safe_write(self, ws, coord, value):
-        try:
-            # 1. 先检查该单元格是否为 MergedCell (只读部分)
-            cell = ws[coord]
-            if isinstance(cell, MergedCell):
-                # 2. 如果是，尝试在所有合并区域中找到它的“父节点”
-                found = False
-                for rng in ws.merged_cells.ranges:
-                    if coord in rng:
-                        # 找到了父节点，写入父节点
-                        ws.cell(row=rng.min_row, column=rng.min_col).value = value
-                        found = True
-                        break
-                
-                if not found:
-                    # 3. 如果是 MergedCell 但找不到父节点 (极罕见，可能是 insert_rows 破坏了索引)
-                    # 策略：跳过写入，打印警告，防止崩溃
-                    print(f"Warning: Skipped writing to broken merged cell {coord}")
-            else:
-                # 4. 如果是普通单元格，直接写
-                ws[coord] = value
-        except Exception as e:
-            # 5. 最后一道防线：任何写入错误都捕获，不让程序崩溃
-            print(f"Error writing to {coord}: {str(e)}")
+        safe_write(ws, coord, value)
 
-    # --- 核心：检查文件是否被占用 ---
     def check_file_lock(self, filename):
-        if os.path.exists(filename):
-            try:
-                # 尝试以追加模式打开文件，如果被 Excel 占用会报错
-                with open(filename, 'a'):
-                    pass
-            except PermissionError:
-                return False
-        return True
+        return check_file_lock(filename)
 
     def create_date_picker(self, parent):
         frame = ttk.Frame(parent)
@@ -144,18 +1820,22 @@ class TravelApp:
         d.config(state=state)
 
     def setup_ui(self):
-        notebook = ttk.Notebook(self.root)
+        self.notebook = notebook = ttk.Notebook(self.root)
         notebook.pack(expand=True, fill='both')
         self.frame_gen = ttk.Frame(notebook)
         notebook.add(self.frame_gen, text="行程录入")
         self.setup_gen_tab()
+        # 人员管理、设置两页第一次切过去时再建，缩短冷启动
         self.frame_user = ttk.Frame(notebook)
         notebook.add(self.frame_user, text="人员管理")
-        self.setup_user_tab()
         self.frame_rules = ttk.Frame(notebook)
         notebook.add(self.frame_rules, text="设置")
-        self.setup_rules_tab()
-        self.refresh_trip_list_ui()
+        self.lazy_tabs = {str(self.frame_user): self.setup_user_tab, str(self.frame_rules): self.setup_rules_tab}
+        notebook.bind("<<NotebookTabChanged>>", self.on_tab_changed)
+
+    def on_tab_changed(self, event):
+        setup = self.lazy_tabs.pop(self.notebook.select(), None)
+        if setup: setup()
 
     def setup_gen_tab(self):
         left_panel = ttk.Frame(self.frame_gen, padding=10)
@@ -167,7 +1847,7 @@ class TravelApp:
         row+=1
         self.cb_users = ttk.Combobox(left_panel, state="readonly", width=25)
         self.cb_users.grid(row=row, column=0, columnspan=2, sticky='ew')
-        self.update_user_combobox()
+        self.cb_users.bind("<<ComboboxSelected>>", lambda e: self.reload_trips())
         row+=1
         ttk.Label(left_panel, text="第二步：录入行程").grid(row=row, column=0, columnspan=2, sticky='w', pady=10)
         row+=1
@@ -203,27 +1883,38 @@ class TravelApp:
         self.entry_reason.grid(row=row+1, column=1, sticky='ew')
         row+=2
         ttk.Button(left_panel, text="⬇️ 添加到列表", command=self.add_trip_to_list).grid(row=row, column=0, columnspan=2, pady=15, sticky='ew')
+        row+=1
+        ttk.Button(left_panel, text="📥 从派车表批量导入", command=self.import_trip_file).grid(row=row, column=0, columnspan=2, sticky='ew')
         
         cols = ("日期", "地点", "金额", "未派车")
-        self.tree_trips = ttk.Treeview(right_panel, columns=cols, show='headings', height=15)
+        self.trip_view = TripListView(right_panel, cols, height=15, on_change=self.update_total_label)
+        self.tree_trips = self.trip_view.tree
         for c in cols: self.tree_trips.heading(c, text=c)
         self.tree_trips.column("日期", width=100); self.tree_trips.column("地点", width=200)
         self.tree_trips.column("金额", width=80); self.tree_trips.column("未派车", width=60)
-        self.tree_trips.pack(fill='both', expand=True)
         
         btn_box = ttk.Frame(right_panel)
         btn_box.pack(fill='x', pady=5)
         ttk.Button(btn_box, text="删除选中行", command=self.del_trip_from_list).pack(side='left')
         ttk.Button(btn_box, text="清空列表", command=self.clear_trip_list).pack(side='left', padx=5)
+        ttk.Button(btn_box, text="📊 全所月度汇总", command=self.generate_monthly_report).pack(side='right')
         
         bottom_frame = ttk.LabelFrame(right_panel, text="生成设置")
         bottom_frame.pack(fill='x', pady=10)
         ttk.Label(bottom_frame, text="填报日期:").pack(side='left', padx=5)
         self.pk_fill = self.create_date_picker(bottom_frame)
         self.pk_fill[0].pack(side='left')
-        ttk.Button(bottom_frame, text="🚀 生成文件", command=self.generate_all_files).pack(side='right', padx=10)
+        self.btn_generate = ttk.Button(bottom_frame, text="🚀 生成文件", command=self.generate_all_files)
+        self.btn_generate.pack(side='right', padx=10)
+        self.var_nocar_book = tk.BooleanVar(value=self.config.get('nocar_output', 'files') == 'workbook')
+        ttk.Checkbutton(bottom_frame, text="未派车证明合并为一个文件", variable=self.var_nocar_book, command=self.on_nocar_book_change).pack(side='right')
         self.lbl_total = ttk.Label(right_panel, text="当前总金额: 0 元")
         self.lbl_total.pack(anchor='e')
+        self.update_user_combobox() # 行程列表建好后再选人，选中即加载其行程
+
+    def on_nocar_book_change(self):
+        self.config['nocar_output'] = 'workbook' if self.var_nocar_book.get() else 'files'
+        self.save_config()
 
     def on_end_point_change(self, event):
         if self.cb_end.get() == "辖区线路":
@@ -238,50 +1929,66 @@ class TravelApp:
         if self.var_same_day.get(): self.set_picker_state(self.pk_end, "disabled")
         else: self.set_picker_state(self.pk_end, "readonly")
 
+    def current_user_name(self):
+        idx = self.cb_users.current()
+        return self.config['users'][idx]['name'] if idx != -1 else None
+
+    def reload_trips(self):
+        # 列表只显示当前报销人尚未归档的行程，历史留在台账里
+        name = self.current_user_name()
+        self.trip_list = list(self.store.query(user=name, archived=False)) if name else []
+        self.trip_index = TripIntervalIndex(self.store.query(user=name)) if name else TripIntervalIndex() # 含历史，跨月份也能查出重复
+        self.refresh_trip_list_ui()
+
     def add_trip_to_list(self):
+        if self.current_user_name() is None: return messagebox.showerror("错误", "请先选择报销人")
         try:
             start_date = datetime.strptime(self.get_date_from_picker(self.pk_start), "%Y-%m-%d")
             end_date = start_date if self.var_same_day.get() else datetime.strptime(self.get_date_from_picker(self.pk_end), "%Y-%m-%d")
         except: return messagebox.showerror("错误", "日期无效")
         
-        start_place, end_place = self.cb_start.get(), self.cb_end.get()
-        trips = []
-        if end_place == "辖区线路":
-            trips.append({"date": start_date, "start": self.config['station_info']['name'].replace("供电所",""), "end": "辖区", 
-                          "food": self.config['rules']['local']['food'], "misc": self.config['rules']['local']['misc'], 
-                          "nocar": self.var_need_nocar.get(), "reason": self.entry_reason.get(), "full_start_date": start_date, "full_end_date": end_date})
-        else:
-            rule = self.config['rules']['county'] if end_place == self.config['station_info']['county'] else self.config['rules']['city']
-            clean_start = start_place.replace("本所", self.config['station_info']['name'].replace("供电所",""))
-            if self.var_same_day.get():
-                trips.append({"date": start_date, "start": clean_start, "end": end_place, "food": 0, "misc": rule['misc_round_trip'], 
-                              "nocar": self.var_need_nocar.get(), "reason": self.entry_reason.get(), "full_start_date": start_date, "full_end_date": end_date})
-            else:
-                trips.append({"date": start_date, "start": clean_start, "end": end_place, "food": 0, "misc": rule['misc_one_way'], 
-                              "nocar": self.var_need_nocar.get(), "reason": self.entry_reason.get(), "full_start_date": start_date, "full_end_date": end_date})
-                trips.append({"date": end_date, "start": end_place, "end": clean_start, "food": 0, "misc": rule['misc_one_way'], 
-                              "nocar": False, "reason": self.entry_reason.get(), "is_return_trip": True})
-        
-        for t in trips: self.trip_list.append(t)
-        self.refresh_trip_list_ui()
+        trips = make_trip_legs(self.config, self.cb_start.get(), self.cb_end.get(), start_date, end_date,
+                               self.var_need_nocar.get(), self.entry_reason.get(), self.pricing)
+        name = self.current_user_name()
+        found = self.trip_index.conflicts(name, trips[0])
+        if found and not messagebox.askyesno("行程冲突", "这条行程与已有行程冲突：\n" + "\n".join(
+                f"{CONFLICT_NAMES[kind]}: {describe_trip(other)}" for kind, other in found[:10]) + "\n\n仍然添加吗？"): return
+        self.store.add(name, trips)
+        for t in trips: self.trip_index.add(name, t)
+        self.trip_view.append(trips)
+
+    def import_trip_file(self):
+        path = filedialog.askopenfilename(title="选择派车/考勤导出文件", filetypes=[("表格", "*.xlsx *.csv"), ("所有文件", "*.*")])
+        if not path: return
+        try: rows, added, errors = import_trips(self.store, self.config, path)
+        except Exception as e:
+            log.exception("导入失败")
+            return messagebox.showerror("导入失败", str(e))
+        self.reload_trips()
+        text = f"读入 {rows} 行，导入 {added} 条报销行程。"
+        if errors:
+            text += f"\n以下 {len(errors)} 行未导入：\n" + "\n".join(f"第 {line} 行: {reason}" for line, reason in errors[:15])
+            if len(errors) > 15: text += f"\n... 另有 {len(errors) - 15} 行"
+            messagebox.showwarning("导入完成", text)
+        else: messagebox.showinfo("导入完成", text)
 
     def del_trip_from_list(self):
-        if self.tree_trips.selection():
-            del self.trip_list[self.tree_trips.index(self.tree_trips.selection()[0])]
-            self.refresh_trip_list_ui()
+        t = self.trip_view.remove_selected()
+        if t:
+            self.store.delete([t.id])
+            self.trip_index.remove(t.user, t)
 
     def clear_trip_list(self):
+        name = self.current_user_name()
+        if name: self.store.archive(name)
         self.trip_list = []
         self.refresh_trip_list_ui()
 
     def refresh_trip_list_ui(self):
-        for i in self.tree_trips.get_children(): self.tree_trips.delete(i)
-        total = 0
-        for t in self.trip_list:
-            cost = t['food'] + t['misc']
-            total += cost
-            self.tree_trips.insert('', 'end', values=(t['date'].strftime("%m-%d"), f"{t['start']}->{t['end']}", cost, "是" if t.get('nocar') else "-"))
-        self.lbl_total.config(text=f"当前总金额: {total} 元")
+        self.trip_view.set_trips(self.trip_list)
+
+    def update_total_label(self, total):
+        self.lbl_total.config(text=f"当前总金额: {fmt_amount(total)} 元")
 
     def generate_all_files(self):
         if not self.trip_list: return messagebox.showerror("错误", "请先添加行程")
@@ -290,93 +1997,100 @@ class TravelApp:
         try: fill_date = datetime.strptime(self.get_date_from_picker(self.pk_fill), "%Y-%m-%d")
         except: return messagebox.showerror("错误", "日期错误")
 
-        self.trip_list.sort(key=lambda x: x['date'])
-        total_money = sum([t['food'] + t['misc'] for t in self.trip_list])
-        min_date, max_date = self.trip_list[0]['date'], self.trip_list[-1]['date']
-        date_desc = f"自 {min_date.year} 年 {min_date.month} 月 {min_date.day} 日 至 {max_date.year} 年 {max_date.month} 月 {max_date.day} 日 计 {(max_date - min_date).days + 1} 天"
-        file_suffix = f"{user['name']}_{fill_date.strftime('%m%d')}"
+        # 生成前对此人全部历史扫一遍，只报和本次待报销行程有关的冲突
+        pending = {t.id for t in self.trip_list}
+        found = [c for c in find_trip_conflicts(self.store.query(user=user['name'])) if c[2].id in pending or c[3].id in pending]
+        if found and not messagebox.askyesno("行程冲突", f"待报销行程中有 {len(found)} 处冲突：\n" + "\n".join(
+                f"{CONFLICT_NAMES[kind]}: {describe_trip(a)} / {describe_trip(b)}" for kind, _, a, b in found[:10]) + "\n\n仍然生成吗？"): return
 
-        # 检查文件占用
-        f1_name = f"1_差旅费报销单_{file_suffix}.xlsx"
-        f2_name = f"2_报销审核单_{file_suffix}.xlsx"
-        if not self.check_file_lock(f1_name) or not self.check_file_lock(f2_name):
-            return messagebox.showerror("错误", "生成的表格文件(如 1_差旅费...xlsx) 正被 Excel 打开。\n请先关闭这些文件，然后再点击生成！")
+        self.trip_list.sort(key=by_day)
+        self.refresh_trip_list_ui()
+        self.start_generation(user, list(self.trip_list), fill_date)
 
-        try:
-            wb = openpyxl.load_workbook(self.config['template_paths']['expense'])
-            ws = wb.active
-            self.safe_write(ws, 'K2', fill_date.year)
-            self.safe_write(ws, 'M2', fill_date.month)
-            self.safe_write(ws, 'O2', fill_date.day)
-            self.safe_write(ws, 'B3', self.config['station_info']['name'])
-            self.safe_write(ws, 'G3', self.config['station_info']['name'])
-            self.safe_write(ws, 'B4', user['name'])
-            self.safe_write(ws, 'E4', self.trip_list[0]['reason'])
-            self.safe_write(ws, 'G4', "详见明细")
-            self.safe_write(ws, 'J4', date_desc)
-            
-            curr_row = 8
-            orig_rows = 6
-            for i, t in enumerate(self.trip_list):
-                if i >= orig_rows: ws.insert_rows(curr_row)
-                self.safe_write(ws, f'A{curr_row}', t['date'].year)
-                self.safe_write(ws, f'B{curr_row}', t['date'].month)
-                self.safe_write(ws, f'C{curr_row}', t['date'].day)
-                self.safe_write(ws, f'D{curr_row}', t['start'])
-                self.safe_write(ws, f'E{curr_row}', t['end'])
-                if t['food']: 
-                    self.safe_write(ws, f'H{curr_row}', 1)
-                    self.safe_write(ws, f'I{curr_row}', t['food'])
-                if t['misc']: 
-                    self.safe_write(ws, f'M{curr_row}', t['misc'])
-                curr_row += 1
-            
-            r_tot, r_bk = 14 + max(0, len(self.trip_list) - orig_rows), 15 + max(0, len(self.trip_list) - orig_rows)
-            
-            self.safe_write(ws, f'G{r_tot}', num_to_cn_amount(total_money))
-            self.safe_write(ws, f'C{r_bk}', user['name'])
-            self.safe_write(ws, f'F{r_bk}', user['card'])
-            self.safe_write(ws, f'K{r_bk}', user['bank'])
-            self.safe_write(ws, f'N{r_bk}', user['phone'])
-            
-            wb.save(f1_name)
-
-            wb2 = openpyxl.load_workbook(self.config['template_paths']['audit'])
-            ws2 = wb2.active
-            self.safe_write(ws2, 'K4', fill_date.year)
-            self.safe_write(ws2, 'M4', fill_date.month)
-            self.safe_write(ws2, 'O4', fill_date.day)
-            self.safe_write(ws2, 'E6', self.config['station_info']['name'])
-            self.safe_write(ws2, 'J10', total_money)
-            self.safe_write(ws2, 'C11', num_to_cn_amount(total_money))
-            self.safe_write(ws2, 'C12', user['name'])
-            self.safe_write(ws2, 'F12', user['card'])
-            self.safe_write(ws2, 'K12', user['bank'])
-            self.safe_write(ws2, 'N12', user['phone'])
-            wb2.save(f2_name)
-
-            nocar_trips = [t for t in self.trip_list if t.get('nocar')]
-            for t in nocar_trips:
-                wb3 = openpyxl.load_workbook(self.config['template_paths']['no_car'])
-                ws3 = wb3.active
-                self.safe_write(ws3, 'F3', t['date'].year)
-                self.safe_write(ws3, 'H3', t['date'].month)
-                self.safe_write(ws3, 'J3', t['date'].day)
-                self.safe_write(ws3, 'B5', self.config['station_info']['name'])
-                self.safe_write(ws3, 'E5', user['name'])
-                self.safe_write(ws3, 'H5', t['end'])
-                self.safe_write(ws3, 'B7', t['reason'])
-                fs, fe = t.get('full_start_date', t['date']), t.get('full_end_date', t['date'])
-                self.safe_write(ws3, 'B8', fs.month)
-                self.safe_write(ws3, 'D8', fs.day)
-                self.safe_write(ws3, 'F8', fe.month)
-                self.safe_write(ws3, 'H8', fe.day)
-                wb3.save(f"3_未派车_{user['name']}_{fs.strftime('%m%d')}_至_{t['end']}.xlsx")
-
-            messagebox.showinfo("成功", f"生成完毕！\n- 报销单: 1份\n- 审核单: 1份\n- 未派车证明: {len(nocar_trips)}份")
+    def generate_monthly_report(self):
+        # 统计填报日期所在的月份
+        try: start, end = month_range(datetime.strptime(self.get_date_from_picker(self.pk_fill), "%Y-%m-%d").strftime("%Y-%m"))
+        except ValueError: return messagebox.showerror("错误", "日期错误")
+        path = f"汇总_{start.strftime('%Y%m')}.xlsx"
+        if not self.check_file_lock(path): return messagebox.showerror("错误", f"{path} 正被 Excel 打开，请先关闭")
+        try: summary = build_rollup_report(self.store, self.config, start, end, path)
+        except Exception as e:
+            log.exception("汇总表生成失败")
+            return messagebox.showerror("错误", f"汇总表生成失败: {e}")
+        messagebox.showinfo("完成", f"{start.year} 年 {start.month} 月共 {len(summary['people'])} 人，已生成 {path}")
 
+    # --- 后台生成：工作线程渲染，主线程用 root.after 轮询队列更新进度 ---
+    def start_generation(self, user, trips, fill_date):
+        self.btn_generate.config(state='disabled')
+        self.gen_queue, self.gen_cancel = queue.Queue(), threading.Event()
+        self.gen_dialog = tk.Toplevel(self.root)
+        self.gen_dialog.title("正在生成")
+        self.gen_dialog.transient(self.root)
+        self.gen_dialog.resizable(False, False)
+        self.gen_dialog.protocol("WM_DELETE_WINDOW", self.cancel_generation)
+        self.lbl_gen = ttk.Label(self.gen_dialog, text="正在读取模板...", width=50)
+        self.lbl_gen.pack(padx=15, pady=(15, 5))
+        self.pb_gen = ttk.Progressbar(self.gen_dialog, length=360, mode='determinate')
+        self.pb_gen.pack(padx=15, pady=5)
+        self.btn_gen_cancel = ttk.Button(self.gen_dialog, text="取消", command=self.cancel_generation)
+        self.btn_gen_cancel.pack(pady=(5, 15))
+        # 配置做一份快照：生成过程中改设置不影响本次任务
+        args = (deepcopy(self.config), user, trips, fill_date, self.gen_queue, self.gen_cancel)
+        self.gen_started = time.perf_counter()
+        threading.Thread(target=self._generation_worker, args=args, daemon=True).start()
+        self.root.after(100, self.poll_generation)
+
+    @staticmethod
+    def _generation_worker(config, user, trips, fill_date, q, cancel):
+        done = []
+        try:
+            with profiling(bool(os.environ.get("TRAVEL_TOOL_PROFILE")), tag="gui") as prof:
+                for i, n, job in iter_documents(config, user, trips, fill_date, cancel=cancel):
+                    done.append(job)
+                    q.put(("progress", i, n, os.path.basename(job['path'])))
+            q.put(("cancelled" if cancel.is_set() else "done", done, prof))
+        except PermissionError: q.put(("locked", done, {}))
         except Exception as e:
-            messagebox.showerror("运行出错", str(e))
+            log.exception("生成失败")
+            q.put(("error", done, {}, str(e)))
+
+    def cancel_generation(self):
+        self.gen_cancel.set()
+        self.btn_gen_cancel.config(state='disabled')
+        self.lbl_gen.config(text="正在取消，等待当前文档写完...")
+
+    def poll_generation(self):
+        try:
+            while True:
+                msg = self.gen_queue.get_nowait()
+                if msg[0] == "progress":
+                    _, i, n, name = msg
+                    self.pb_gen.config(maximum=n, value=i)
+                    self.lbl_gen.config(text=f"已完成 {i}/{n}: {name}")
+                else: return self.finish_generation(msg)
+        except queue.Empty: pass
+        self.root.after(100, self.poll_generation)
+
+    def finish_generation(self, msg):
+        self.gen_dialog.destroy()
+        self.btn_generate.config(state='normal')
+        status, done, prof = msg[0], msg[1], msg[2]
+        metrics = GenerationMetrics()
+        for j in done: metrics.merge(j['metrics'])
+        write_run_report({"mode": "gui", "run_at": datetime.now().isoformat(timespec='seconds'), "status": status,
+                          "wall_seconds": round(time.perf_counter() - self.gen_started, 3), "backend": self.config.get('render_backend', 'openpyxl'),
+                          "user": self.current_user_name(), "trips": len(self.trip_list), **metrics.to_dict(), "profile": prof,
+                          "documents": [{"path": j['path'], "kind": j['kind'], **j['metrics']} for j in done]})
+        counts = {k: sum(len(j['trips']) if k == 'no_car_book' else 1 for j in done if j['kind'] == k) for k in RENDERERS}
+        summary = f"- 报销单: {counts['expense']}份\n- 审核单: {counts['audit']}份\n- 未派车证明: {counts['no_car'] + counts['no_car_book']}份"
+        skipped = sum(1 for j in done if j.get('skipped'))
+        if skipped: summary += f"\n(其中 {skipped} 份内容未变化，未重新生成)"
+        if status == "done": messagebox.showinfo("成功", f"生成完毕！\n{summary}")
+        elif status == "cancelled": messagebox.showwarning("已取消", f"已取消生成，以下文件已完整保存：\n{summary}")
+        elif status == "locked":
+            # 检查文件占用
+            messagebox.showerror("错误", "生成的表格文件(如 1_差旅费...xlsx) 正被 Excel 打开。\n请先关闭这些文件，然后再点击生成！")
+        else: messagebox.showerror("运行出错", msg[3])
 
     def setup_user_tab(self):
         p = ttk.Frame(self.frame_user, padding=10)
@@ -411,6 +2125,9 @@ class TravelApp:
         self.cb_users['values'] = names
         if self.config['current_user_index'] >= 0 and self.config['current_user_index'] < len(names):
             self.cb_users.current(self.config['current_user_index'])
+        else: self.cb_users.set("")
+        # 代码里改选中项不会触发 <<ComboboxSelected>>，这里手动刷新列表和查重索引 (删人后不留他的行程)
+        self.reload_trips()
 
     def add_user(self):
         u = {k: v.get() for k, v in self.entries_user.items()}
@@ -481,11 +2198,18 @@ class TravelApp:
             self.config['rules']['city']['misc_one_way'] = float(self.e_city_single.get())
         except ValueError: return messagebox.showerror("错误", "费用必须是数字")
         self.save_config()
+        self.pricing = PricingTable.from_config(self.config)
         self.cb_start['values'] = ["本所", self.config['station_info']['county'], self.config['station_info']['city']]
         self.cb_end['values'] = ["辖区线路", self.config['station_info']['county'], self.config['station_info']['city']]
         messagebox.showinfo("成功", "设置已保存")
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    if len(sys.argv) > 1: sys.exit(main())
+    # 打包后的 exe 没有控制台，警告和错误写到日志文件
+    os.makedirs(LOG_DIR, exist_ok=True)
+    logging.basicConfig(filename=os.path.join(LOG_DIR, "travel_tool.log"), level=logging.INFO,
+                        format="%(asctime)s %(levelname)s %(message)s", encoding="utf-8")
     root = tk.Tk()
     app = TravelApp(root)
     root.mainloop()